@@ -0,0 +1,302 @@
+
+import os
+import sys
+import html
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+
+from ..wikitablestosql import wikitableparser
+from ..wikitablestosql import wikitableprocessing
+from ..wikitablestosql import multistreamfilehandling
+from ..wikitablestosql import tosql
+from ..tests import test_pipeline
+from . import synthetic_tables
+
+default_data_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests',
+                                 'test_rawtosql_data.json')
+default_baseline_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+# Number of streams of the end-to-end dump (each stream holds every wikitable of the corpus once)
+dump_streams = 2
+
+
+def load_recorded_wikitables(data_file=default_data_file):
+    """
+    Load the raw wikitables recorded in the test data.
+
+    :param data_file: path as string
+    :return: raw wikitables by name, as dict
+    """
+
+    with open(data_file, mode='r', encoding='UTF-8') as f:
+        loaded = json.load(f)
+
+    return {i['raw']['PageName'] + '_' + str(i['raw']['TableId']): i['raw']['WikitableData'] for i in loaded}
+
+
+# Benchmark cases: prepare(raw_wikitables, directory) returns the state of run(state), which returns its number of
+# operations
+def prepare_pages(raw_wikitables, directory):
+    return ['Introduction\n' + k + '\nConclusion' for k in raw_wikitables]
+
+
+def run_get_wikitables_from_string(pages):
+    for k in pages:
+        wikitableprocessing.get_wikitables_from_string(k)
+    return len(pages)
+
+
+def prepare_table_content(raw_wikitables, directory):
+    return [k.splitlines()[1:-1] for k in raw_wikitables]
+
+
+def run_first_pass(table_contents):
+    for k in table_contents:
+        wikitableparser.first_pass(k)
+    return len(table_contents)
+
+
+def run_first_pass_tokens(table_contents):
+    for k in table_contents:
+        wikitableparser.first_pass_tokens(k)
+    return len(table_contents)
+
+
+def prepare_raw(raw_wikitables, directory):
+    return raw_wikitables
+
+
+def run_wikitable_parser_token(raw_wikitables):
+    for k, raw in enumerate(raw_wikitables):
+        wikitableparser.wikitable_parser(raw, 'Page', k, 'token')
+    return len(raw_wikitables)
+
+
+def run_wikitable_parser_char(raw_wikitables):
+    for k, raw in enumerate(raw_wikitables):
+        wikitableparser.wikitable_parser(raw, 'Page', k, 'char')
+    return len(raw_wikitables)
+
+
+def prepare_parsed(raw_wikitables, directory):
+    parsed = [wikitableparser.wikitable_parser(raw, 'Page', k) for k, raw in enumerate(raw_wikitables)]
+    return {'database': os.path.join(directory, 'insert.db'),
+            'parsed': [k for k in parsed if isinstance(k, dict)]}
+
+
+def run_tosql_insert(state):
+    if os.path.exists(state['database']):
+        os.remove(state['database'])
+    tosql.sql_table_creation(state['database'])
+    writer_state = tosql.open_writer(state['database'])
+    tosql.write_wikitables(writer_state, state['parsed'])
+    tosql.commit(writer_state)
+    tosql.close_writer(writer_state)
+    return len(state['parsed'])
+
+
+def prepare_dump(raw_wikitables, directory):
+    # same dump as the pipeline tests, with one page per raw wikitable in each stream
+    pages = []
+    for stream in range(dump_streams):
+        for k, raw_wikitable in enumerate(raw_wikitables):
+            page_id = stream * len(raw_wikitables) + k + 1
+            # raw wikitables are stored in their xml escaped form
+            pages.append((page_id, 'Page ' + str(page_id), page_id,
+                          'Introduction\n' + html.unescape(raw_wikitable) + '\nConclusion'))
+    data_file, index = test_pipeline.write_dump(directory, pages, pages_per_stream=len(raw_wikitables))
+    return {'directory': directory, 'data_file': data_file, 'index': index,
+            'page_count': len(raw_wikitables) * dump_streams,
+            'database': os.path.join(directory, 'end_to_end.db')}
+
+
+def run_end_to_end(state):
+    # all stages of a worker and of the writer, in a single process
+    if os.path.exists(state['database']):
+        os.remove(state['database'])
+    tosql.sql_table_creation(state['database'])
+    writer_state = tosql.open_writer(state['database'])
+    mapped_file = multistreamfilehandling.map_multistream_file(os.path.join(state['directory'], state['data_file']))
+    for byte_offset, length, last_stream in multistreamfilehandling.get_streams(state['directory'],
+                                                                                state['data_file'], state['index']):
+        compressed_stream = multistreamfilehandling.slice_stream(mapped_file, byte_offset, length)
+        chunks = multistreamfilehandling.iter_decompress_stream(compressed_stream)
+        parsed = wikitableprocessing.parse_wikitables_from_chunks(chunks, last_stream)
+        compressed_stream.release()
+        tosql.write_wikitables(writer_state, [k for k in parsed if isinstance(k, dict)])
+    tosql.commit(writer_state)
+    tosql.close_writer(writer_state)
+    mapped_file.close()
+    return state['page_count']
+
+
+cases = {'get_wikitables_from_string': (prepare_pages, run_get_wikitables_from_string),
+         'first_pass': (prepare_table_content, run_first_pass),
+         'first_pass_tokens': (prepare_table_content, run_first_pass_tokens),
+         'wikitable_parser_token': (prepare_raw, run_wikitable_parser_token),
+         'wikitable_parser_char': (prepare_raw, run_wikitable_parser_char),
+         'tosql_insert': (prepare_parsed, run_tosql_insert),
+         'end_to_end': (prepare_dump, run_end_to_end)}
+
+
+def measure(run, state, min_time=1.0, repeat=3):
+    """
+    Measure the throughput and the peak memory of a benchmark case.
+
+    :param run: function of the case
+    :param state: state returned by the prepare function of the case
+    :param min_time: minimum seconds per repetition, as float
+    :param repeat: number of repetitions (the best one is kept), as int
+    :return: dict with 'ops_per_second' and 'peak_memory' (bytes allocated at peak during one run)
+    """
+
+    best = 0.0
+    for k in range(repeat):
+        operations = 0
+        start = time.perf_counter()
+        while True:
+            operations += run(state)
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = max(best, operations / elapsed)
+
+    tracemalloc.start()
+    try:
+        run(state)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {'ops_per_second': best, 'peak_memory': peak_memory}
+
+
+def run_benchmarks(corpora, case_names, min_time=1.0, repeat=3):
+    """
+    Run the benchmark cases on each corpus.
+
+    :param corpora: raw wikitables by name by corpus name, as dict
+    :param case_names: list of case names (see cases)
+    :param min_time: minimum seconds per repetition, as float
+    :param repeat: number of repetitions, as int
+    :return: results by corpus name by case name, as dict
+    """
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for case_name in case_names:
+            prepare, run = cases[case_name]
+            results[case_name] = {}
+            for corpus_name, raw_wikitables in corpora.items():
+                state = prepare(list(raw_wikitables.values()), directory)
+                results[case_name][corpus_name] = measure(run, state, min_time, repeat)
+                print(format_result(case_name, corpus_name, results[case_name][corpus_name]))
+
+    return results
+
+
+def get_environment():
+    """
+    Describe the environment the benchmarks run in (results are only comparable in the same environment).
+
+    :return: dict
+    """
+
+    return {'python': platform.python_implementation() + ' ' + platform.python_version(),
+            'machine': platform.machine(),
+            'compiled_parser': wikitableparser.compiled}
+
+
+def compare_to_baseline(results, baseline, tolerance=0.25):
+    """
+    Find the regressions of results against a baseline.
+
+    :param results: results by corpus name by case name, as dict (see run_benchmarks)
+    :param baseline: stored results, as dict with 'environment', 'scale' and 'results'
+    :param tolerance: accepted relative slowdown or memory increase, as float
+    :return: list of regression descriptions (strings)
+    """
+
+    regressions = []
+    for case_name, by_corpus in results.items():
+        for corpus_name, result in by_corpus.items():
+            reference = baseline['results'].get(case_name, {}).get(corpus_name)
+            if reference is None:
+                continue
+            if result['ops_per_second'] < reference['ops_per_second'] * (1 - tolerance):
+                regressions.append('{} [{}]: {:.1f} ops/s (baseline: {:.1f} ops/s)'.format(
+                    case_name, corpus_name, result['ops_per_second'], reference['ops_per_second']))
+            if result['peak_memory'] > reference['peak_memory'] * (1 + tolerance):
+                regressions.append('{} [{}]: peak memory {} bytes (baseline: {} bytes)'.format(
+                    case_name, corpus_name, result['peak_memory'], reference['peak_memory']))
+
+    return regressions
+
+
+def format_result(case_name, corpus_name, result):
+    return '{:<28}{:<12}{:>14.1f} ops/s{:>12.1f} MB peak'.format(case_name, corpus_name, result['ops_per_second'],
+                                                                  result['peak_memory'] / 1e6)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the wikitable extraction, parsing and insertion on the '
+                                                 'recorded test wikitables and on synthetic pathological wikitables.')
+    parser.add_argument('--corpus', choices=['recorded', 'synthetic', 'all'], default='all',
+                        help='wikitables to run the benchmarks on (default: all)')
+    parser.add_argument('--cases', nargs='+', choices=list(cases), default=list(cases), metavar='CASE',
+                        help='benchmark cases to run (default: all): ' + ', '.join(cases))
+    parser.add_argument('--scale', type=int, default=1,
+                        help='size multiplier of the synthetic wikitables (default: 1)')
+    parser.add_argument('--min-time', type=float, default=1.0,
+                        help='minimum seconds per repetition (default: 1.0)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of repetitions, the best one is kept (default: 3)')
+    parser.add_argument('--baseline', type=str, default=default_baseline_file, metavar='FILE',
+                        help='baseline results to compare to (default: benchmarks/baseline.json)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline instead of comparing them')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='accepted relative slowdown or memory increase before a regression is reported '
+                             '(default: 0.25)')
+    args = parser.parse_args()
+
+    corpora = {}
+    if args.corpus in ('recorded', 'all'):
+        corpora['recorded'] = load_recorded_wikitables()
+    if args.corpus in ('synthetic', 'all'):
+        corpora['synthetic'] = synthetic_tables.get_synthetic_wikitables(args.scale)
+
+    results = run_benchmarks(corpora, args.cases, args.min_time, args.repeat)
+
+    if args.save_baseline:
+        with open(args.baseline, mode='w', encoding='UTF-8') as f:
+            json.dump({'environment': get_environment(), 'scale': args.scale, 'results': results}, f, indent=2,
+                      sort_keys=True)
+            f.write('\n')
+        print('Baseline saved to ' + args.baseline)
+        return
+
+    if not os.path.exists(args.baseline):
+        print('No baseline to compare to: record one with --save-baseline.')
+        return
+    with open(args.baseline, mode='r', encoding='UTF-8') as f:
+        baseline = json.load(f)
+    if baseline['scale'] != args.scale:
+        print('The baseline was recorded with --scale ' + str(baseline['scale']) + ', it cannot be compared to.')
+        return
+    if baseline['environment'] != get_environment():
+        print('Warning: the baseline was recorded in another environment: ' + json.dumps(baseline['environment']))
+    regressions = compare_to_baseline(results, baseline, args.tolerance)
+    if regressions:
+        print('Regressions:')
+        for k in regressions:
+            print('  ' + k)
+        sys.exit(1)
+    print('No regression.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+
+import random
+
+
+def huge_rows_table(rows=5000, columns=8):
+    """
+    Wikitable with many rows of short cells.
+
+    :param rows: int
+    :param columns: int
+    :return: raw wikitable as string
+    """
+
+    lines = ['{| class="wikitable sortable"', '|+ Huge table',
+             '! ' + ' !! '.join('Column ' + str(k) for k in range(columns))]
+    for row in range(rows):
+        lines.append('|-')
+        lines.append('| ' + ' || '.join(str(row * columns + k) for k in range(columns)))
+    lines.append('|}')
+    return '\n'.join(lines)
+
+
+def nested_table(depth=200, rows=3):
+    """
+    Wikitable whose first cell holds a wikitable, down to depth levels.
+
+    :param depth: int
+    :param rows: int
+    :return: raw wikitable as string
+    """
+
+    table = '{| class="wikitable"\n| innermost\n|}'
+    for level in range(depth):
+        lines = ['{| class="wikitable" style="margin:0"', '|-', '| level ' + str(level), '|', table]
+        for row in range(rows):
+            lines.append('|-')
+            lines.append('| a' + str(row) + ' || b' + str(row))
+        lines.append('|}')
+        table = '\n'.join(lines)
+    return table
+
+
+def dense_templates_table(rows=500, columns=6, templates_per_cell=4):
+    """
+    Wikitable whose cells are made of templates and links holding '|' characters.
+
+    :param rows: int
+    :param columns: int
+    :param templates_per_cell: int
+    :return: raw wikitable as string
+    """
+
+    cell = ' '.join('{{flagicon|X' + str(k) + '|size=20px}} [[Page ' + str(k) + '|label ' + str(k) +
+                    ']] {{sort|' + str(k) + '|{{nts|' + str(k) + '}}}}' for k in range(templates_per_cell))
+    lines = ['{| class="wikitable"', '! ' + ' !! '.join('{{abbr|C' + str(k) + '|Column ' + str(k) + '}}'
+                                                        for k in range(columns))]
+    for row in range(rows):
+        lines.append('|-')
+        lines.append('| style="text-align:left" | ' + cell + ' || ' + ' || '.join([cell] * (columns - 1)))
+    lines.append('|}')
+    return '\n'.join(lines)
+
+
+def long_brace_runs_table(rows=200, run_length=200, seed=0):
+    """
+    Wikitable whose cells hold long runs of curly braces and square brackets, balanced or not.
+
+    :param rows: int
+    :param run_length: int
+    :param seed: int
+    :return: raw wikitable as string
+    """
+
+    generator = random.Random(seed)
+    lines = ['{| class="wikitable"', '! Braces !! Brackets']
+    for row in range(rows):
+        opening = generator.randint(run_length // 2, run_length)
+        closing = generator.randint(run_length // 2, run_length)
+        lines.append('|-')
+        lines.append('| ' + '{' * opening + 'x|y' + '}' * closing + ' || ' + '[' * closing + 'a|b' + ']' * opening)
+    lines.append('|}')
+    return '\n'.join(lines)
+
+
+def get_synthetic_wikitables(scale=1):
+    """
+    Get the synthetic pathological wikitables.
+
+    :param scale: size multiplier as int
+    :return: raw wikitables by name, as dict
+    """
+
+    return {'huge_rows': huge_rows_table(rows=5000 * scale),
+            'nested': nested_table(depth=200 * scale),
+            'dense_templates': dense_templates_table(rows=500 * scale),
+            'long_brace_runs': long_brace_runs_table(rows=200 * scale)}
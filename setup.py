@@ -1,8 +1,25 @@
+import os
+
 import setuptools
 
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    cythonize = None
+
 with open("README.md", "r") as fh:
     long_description = fh.read()
 
+# Optional compiled wikitable parser: built from the pure Python module when Cython is available
+# (set WIKITABLESTOSQL_PURE_PYTHON to skip it), the pure Python module is used if the build fails
+ext_modules = []
+if cythonize is not None and 'WIKITABLESTOSQL_PURE_PYTHON' not in os.environ:
+    ext_modules = cythonize([setuptools.Extension('wikitablestosql.wikitableparser',
+                                                  ['wikitablestosql/wikitableparser.py'])],
+                            compiler_directives={'language_level': 3})
+    for extension in ext_modules:
+        extension.optional = True
+
 setuptools.setup(
     name="wikitablestosql",
     version="1.0.0",
@@ -24,4 +41,6 @@ setuptools.setup(
     ],
     python_requires='>=3.5',
     install_requires=['defusedxml'],
+    extras_require={'arrow': ['pyarrow']},
+    ext_modules=ext_modules,
 )
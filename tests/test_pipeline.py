@@ -0,0 +1,494 @@
+
+import os
+import bz2
+import sys
+import html
+import json
+import time
+import signal
+import sqlite3
+import tempfile
+import subprocess
+from xml.sax.saxutils import escape
+
+from ..wikitablestosql import wikitablestosql
+from ..wikitablestosql import multistreamfilehandling
+from ..wikitablestosql import tablecache
+from ..wikitablestosql import wikitableparser
+from ..wikitablestosql import toarrow
+from ..wikitablestosql import tosql
+
+test_data_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_rawtosql_data.json')
+repository_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def new_pages(copies=1):
+    """
+    Create the pages of a test dump: one page per wikitable of the test data (per copy) and pages without table
+
+    :param copies: number of copies of the test data as int
+    :return: list of (page_id, title, revision_id, text)
+    """
+
+    with open(test_data_file, mode='r', encoding='UTF-8') as f:
+        loaded = json.load(f)
+
+    pages = []
+    for copy in range(copies):
+        for k, i in enumerate(loaded):
+            page_id = copy * 1000 + k + 1
+            pages.append((page_id, i['raw']['PageName'] + ' ' + str(copy), page_id * 10,
+                          'Introduction\n' + html.unescape(i['raw']['WikitableData']) + '\nConclusion'))
+        for k in range(len(loaded), len(loaded) + 5):
+            page_id = copy * 1000 + k + 1
+            pages.append((page_id, 'Plain page ' + str(page_id), page_id * 10, 'No table here.'))
+    return pages
+
+
+def write_dump(directory, pages, date='20200101', pages_per_stream=10):
+    """
+    Write a multistream dump (one multistream file and its index) of pages
+
+    :param directory: path as string
+    :param pages: list of (page_id, title, revision_id, text)
+    :param date: dump date as string
+    :param pages_per_stream: int
+    :return: (multistream_filename, index_filename)
+    """
+
+    prefix = 'testwiki-' + date + '-pages-articles-multistream'
+    data = bz2.compress(b'<mediawiki>\n  <siteinfo>\n    <sitename>Test</sitename>\n  </siteinfo>\n')
+    index_lines = []
+    for k in range(0, len(pages), pages_per_stream):
+        stream = []
+        for page_id, title, revision_id, text in pages[k:k + pages_per_stream]:
+            index_lines.append(str(len(data)) + ':' + str(page_id) + ':' + escape(title))
+            stream.append('<page><title>' + escape(title) + '</title><ns>0</ns><id>' + str(page_id) +
+                          '</id><revision><id>' + str(revision_id) + '</id><text xml:space="preserve">' +
+                          escape(text) + '</text></revision></page>\n')
+        data += bz2.compress(''.join(stream).encode('UTF-8'))
+    data += bz2.compress(b'</mediawiki>\n')
+
+    data_file = prefix + '1.xml-p1p99999.bz2'
+    index = prefix + '-index1.txt-p1p99999.bz2'
+    with open(os.path.join(directory, data_file), mode='wb') as f:
+        f.write(data)
+    with open(os.path.join(directory, index), mode='wb') as f:
+        f.write(bz2.compress(('\n'.join(index_lines) + '\n').encode('UTF-8')))
+
+    return data_file, index
+
+
+def count_ingested_streams(database):
+    """
+    Count the streams recorded as ingested in database (0 if it cannot be read yet)
+
+    :param database: path as string
+    :return: int
+    """
+
+    if not os.path.exists(database):
+        return 0
+    try:
+        connection = sqlite3.connect(database, timeout=0.1)
+        try:
+            return connection.execute('SELECT COUNT(*) FROM IngestedStreams').fetchone()[0]
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return 0
+
+
+def run_cli(dump_directory, output_directory, arguments=(), interrupt=False, timeout=300):
+    """
+    Run wikitablestosql on a dump in a separate process
+
+    :param dump_directory: path as string
+    :param output_directory: working directory of the run (where the database is written) as string
+    :param arguments: other command line arguments
+    :param interrupt: True to send Ctrl-C (SIGINT to the whole process group) once a stream is committed, as bool
+    :param timeout: seconds as int
+    :return: (exit status, output as string), None if the run did not end in time
+    """
+
+    environment = dict(os.environ, PYTHONPATH=repository_directory)
+    process = subprocess.Popen([sys.executable, '-m', 'wikitablestosql', dump_directory] + list(arguments),
+                               cwd=output_directory, env=environment, stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+    if interrupt:
+        database = os.path.join(output_directory, wikitablestosql.get_database_filename(dump_directory))
+        while process.poll() is None and count_ingested_streams(database) == 0:
+            time.sleep(0.01)
+        if process.poll() is None:
+            os.killpg(process.pid, signal.SIGINT)
+    try:
+        output = process.communicate(timeout=timeout)[0]
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.communicate()
+        return None
+
+    return process.returncode, output.decode('UTF-8', 'replace')
+
+
+def get_database_content(database):
+    """
+    Get the wikitables and page revisions of a database in either schema, independently of row order and table ids
+
+    :param database: path as string
+    :return: (table information, table data, page revisions) as sorted lists
+    """
+
+    connection = sqlite3.connect(database)
+    try:
+        compact = connection.execute("SELECT name FROM sqlite_master WHERE name = 'WikitableRows'").fetchone()
+        if compact is None:
+            information = sorted(connection.execute('SELECT * FROM WikitableInformation'))
+            data = sorted(connection.execute('SELECT * FROM WikitableData'))
+        else:
+            rows = connection.execute('SELECT table_id, page_name, table_index, table_attributes, caption, '
+                                      'caption_attributes FROM WikitableInformation').fetchall()
+            tables = {k[0]: k[1:3] for k in rows}
+            information = sorted(k[1:] for k in rows)
+            data = sorted(tables[k[0]] + k[1:] for k in connection.execute('SELECT * FROM WikitableData'))
+            data += sorted(tables[k[0]] + k[1:] for k in connection.execute('SELECT * FROM WikitableRows'))
+        revisions = sorted(connection.execute('SELECT * FROM PageRevisions'))
+    finally:
+        connection.close()
+
+    return information, data, revisions
+
+
+def check_interrupt_and_resume(arguments=()):
+    """
+    Check that a run interrupted with Ctrl-C ends, and that resuming it gives the database of an uninterrupted run
+
+    :param arguments: other command line arguments
+    :return: bool
+    """
+
+    arguments = ['--transaction-size', '10'] + list(arguments)
+    with tempfile.TemporaryDirectory() as directory:
+        dump_directory = os.path.join(directory, 'dump')
+        os.mkdir(dump_directory)
+        write_dump(dump_directory, new_pages(copies=20), pages_per_stream=5)
+        database_filename = wikitablestosql.get_database_filename(dump_directory)
+        for run in ('full', 'interrupted'):
+            os.mkdir(os.path.join(directory, run))
+
+        if run_cli(dump_directory, os.path.join(directory, 'full'), arguments) is None:
+            return False
+        if run_cli(dump_directory, os.path.join(directory, 'interrupted'), arguments, interrupt=True) is None:
+            return False
+        result = run_cli(dump_directory, os.path.join(directory, 'interrupted'), arguments)
+        if result is None or result[0] != 0 or 'Resuming' not in result[1]:
+            return False
+
+        return get_database_content(os.path.join(directory, 'full', database_filename)) == \
+            get_database_content(os.path.join(directory, 'interrupted', database_filename))
+
+
+def check_corrupt_stream():
+    """
+    Check that a run ends with an error when a worker fails on a corrupt stream
+
+    :return: bool
+    """
+
+    with tempfile.TemporaryDirectory() as directory:
+        dump_directory = os.path.join(directory, 'dump')
+        os.mkdir(dump_directory)
+        write_dump(dump_directory, new_pages(copies=2))
+        data_file = [k for k in os.listdir(dump_directory) if '-index' not in k][0]
+        with open(os.path.join(dump_directory, data_file), mode='r+b') as f:
+            # inside the second page stream
+            f.seek(len(f.read()) // 2)
+            f.write(bytes(50))
+        os.mkdir(os.path.join(directory, 'output'))
+        result = run_cli(dump_directory, os.path.join(directory, 'output'), timeout=60)
+
+    return result is not None and result[0] != 0
+
+
+def new_dump_directory(directory, name, pages, date='20200101', pages_per_stream=10):
+    """
+    Write a dump in a new folder of directory
+
+    :param directory: path as string
+    :param name: folder name as string
+    :param pages: list of (page_id, title, revision_id, text)
+    :param date: dump date as string
+    :param pages_per_stream: int
+    :return: path of the dump folder as string
+    """
+
+    dump_directory = os.path.join(directory, name)
+    os.mkdir(dump_directory)
+    write_dump(dump_directory, pages, date, pages_per_stream)
+    return dump_directory
+
+
+def run_to_database(dump_directory, output_directory, arguments=()):
+    """
+    Run wikitablestosql in a new output folder
+
+    :param dump_directory: path as string
+    :param output_directory: path as string (created)
+    :param arguments: other command line arguments
+    :return: (path of the database, output as string), None if the run failed
+    """
+
+    os.mkdir(output_directory)
+    result = run_cli(dump_directory, output_directory, arguments)
+    if result is None or result[0] != 0:
+        return None
+    return os.path.join(output_directory, wikitablestosql.get_database_filename(dump_directory)), result[1]
+
+
+def check_refresh():
+    """
+    Check that refreshing the database of a dump with a newer dump (removed, changed, renamed and new pages, a
+    page which gained a wikitable, a removed page re-created with a new id and two pages which swapped their titles)
+    gives the database of a full run on the newer dump
+
+    :return: bool
+    """
+
+    pages = new_pages(copies=2)
+    new = list(pages)
+    # removed page, changed page, renamed page, page which gained a wikitable and new page
+    del new[0]
+    page_id, title, revision_id, text = new[1]
+    new[1] = (page_id, title, revision_id + 1, text.replace('|', '| changed ', 3))
+    page_id, title, revision_id, text = new[2]
+    new[2] = (page_id, title + ' (renamed)', revision_id + 1, text)
+    page_id, title, revision_id, text = new[-1]
+    new[-1] = (page_id, title, revision_id + 1, text + '\n{| class="new"\n|x||y\n|}')
+    new.append((99999, 'New page', 999990, 'Introduction\n{|\n!h1!!h2\n|-\n|1||2\n|}'))
+    new.append((99998, pages[0][1], 999980, 'Re-created\n{|\n!h3!!h4\n|-\n|3||4\n|}'))
+    # titles swapped by pages of different streams
+    (first_id, first_title, first_revision, first_text), (second_id, second_title, second_revision, second_text) = \
+        new[3], new[25]
+    new[3] = (first_id, second_title, first_revision + 1, first_text)
+    new[25] = (second_id, first_title, second_revision + 1, second_text)
+
+    with tempfile.TemporaryDirectory() as directory:
+        dump_directory = new_dump_directory(directory, 'dump', pages)
+        newer_directory = new_dump_directory(directory, 'newer_dump', new, date='20210101')
+        for schema, arguments in (('default', []), ('compact', ['--compact'])):
+            previous = run_to_database(dump_directory, os.path.join(directory, 'previous_' + schema), arguments)
+            full = run_to_database(newer_directory, os.path.join(directory, 'full_' + schema), arguments)
+            if previous is None or full is None:
+                return False
+            refreshed = run_to_database(newer_directory, os.path.join(directory, 'refreshed_' + schema),
+                                        ['--refresh-from', previous[0]])
+            if refreshed is None or 'Removed pages: 1' not in refreshed[1]:
+                return False
+            if get_database_content(full[0]) != get_database_content(refreshed[0]):
+                return False
+
+    return True
+
+
+def check_compact_schema():
+    """
+    Check that the compact schema holds the same wikitables as the default schema
+
+    :return: bool
+    """
+
+    with tempfile.TemporaryDirectory() as directory:
+        dump_directory = new_dump_directory(directory, 'dump', new_pages())
+        default = run_to_database(dump_directory, os.path.join(directory, 'default'))
+        compact = run_to_database(dump_directory, os.path.join(directory, 'compact'), ['--compact'])
+        if default is None or compact is None or tosql.get_schema(compact[0]) != 'compact':
+            return False
+
+        connection = sqlite3.connect(default[0])
+        information = sorted(connection.execute('SELECT * FROM WikitableInformation'))
+        data = {k[:3]: k[3:] for k in connection.execute('SELECT * FROM WikitableData')}
+        connection.close()
+        connection = sqlite3.connect(compact[0])
+        tables = {k[0]: k[1] + '_' + str(k[2]) for k in
+                  connection.execute('SELECT table_id, page_name, table_index FROM WikitableInformation')}
+        compact_information = sorted((k[0], tables[k[1]]) + k[2:] for k in connection.execute(
+            'SELECT page_name, table_id, table_attributes, caption, caption_attributes, page_id '
+            'FROM WikitableInformation'))
+        row_attributes = {(tables[k[0]], k[1]): k[2] for k in connection.execute('SELECT * FROM WikitableRows')}
+        compact_data = {(tables[k[0]],) + k[1:3]: k[3:] for k in connection.execute('SELECT * FROM WikitableData')}
+        connection.close()
+
+    if information != compact_information or data.keys() != compact_data.keys():
+        return False
+    for key, (cell_data, cell_attributes, is_header, row_span, col_span) in data.items():
+        # the compact schema only keeps the attributes of the cell itself
+        own_attributes = tosql.own_attribute(cell_attributes, row_attributes.get(key[:2], ''))
+        if compact_data[key] != (cell_data, own_attributes, is_header, row_span, col_span):
+            return False
+
+    return True
+
+
+def check_arrow_output():
+    """
+    Check that the Parquet and Arrow IPC files hold the rows of the sqlite3 database (skipped without pyarrow)
+
+    :return: bool
+    """
+
+    if toarrow.pyarrow_check is None:
+        return True
+
+    with tempfile.TemporaryDirectory() as directory:
+        dump_directory = new_dump_directory(directory, 'dump', new_pages())
+        database = run_to_database(dump_directory, os.path.join(directory, 'sqlite'))
+        if database is None:
+            return False
+        connection = sqlite3.connect(database[0])
+        expected = {table: sorted(connection.execute('SELECT * FROM ' + table))
+                    for table in ('WikitableInformation', 'WikitableData')}
+        connection.close()
+
+        for output_format in ('parquet', 'arrow'):
+            output_directory = os.path.join(directory, output_format)
+            os.mkdir(output_directory)
+            result = run_cli(dump_directory, output_directory, ['--output-format', output_format])
+            if result is None or result[0] != 0:
+                return False
+            filenames = toarrow.get_output_filenames(wikitablestosql.get_output_base(dump_directory), output_format)
+            for table, filename in filenames.items():
+                path = os.path.join(output_directory, filename)
+                if output_format == 'parquet':
+                    content = toarrow.pq.read_table(path)
+                else:
+                    with toarrow.pa.memory_map(path) as source:
+                        content = toarrow.pa.ipc.open_file(source).read_all()
+                rows = sorted(tuple(k.values()) for k in content.to_pylist())
+                if rows != expected[table]:
+                    return False
+
+    return True
+
+
+def check_table_cache():
+    """
+    Check that a run reading its wikitables from the table cache gives the database of a run without cache
+
+    :return: bool
+    """
+
+    with tempfile.TemporaryDirectory() as directory:
+        dump_directory = new_dump_directory(directory, 'dump', new_pages())
+        cache = os.path.join(directory, 'table_cache.db')
+        reference = run_to_database(dump_directory, os.path.join(directory, 'reference'))
+        first = run_to_database(dump_directory, os.path.join(directory, 'first'), ['--table-cache', cache])
+        second = run_to_database(dump_directory, os.path.join(directory, 'second'), ['--table-cache', cache])
+        if reference is None or first is None or second is None:
+            return False
+        if 'hits: 0' not in first[1] or 'misses: 0' not in second[1]:
+            return False
+        return get_database_content(reference[0]) == get_database_content(first[0]) == \
+            get_database_content(second[0])
+
+
+def check_table_cache_eviction():
+    """
+    Check that the least recently used wikitables are evicted from a full table cache, and that the cache is
+    cleared when its version changes
+
+    :return: bool
+    """
+
+    with open(test_data_file, mode='r', encoding='UTF-8') as f:
+        raw_wikitables = [i['raw']['WikitableData'] for i in json.load(f)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'table_cache.db')
+        max_size = 3000
+        table_cache = tablecache.open_table_cache(filename, max_size)
+        reader = tablecache.open_table_cache_reader(filename)
+        for k, raw_wikitable in enumerate(raw_wikitables):
+            tablecache.parse_wikitable(reader, raw_wikitable, 'Page', k)
+            # the first wikitable is used again each time
+            tablecache.parse_wikitable(reader, raw_wikitables[0], 'Page', 0)
+            tablecache.store_table_cache_updates(table_cache, tablecache.take_table_cache_updates(reader))
+            size = reader['connection'].execute('SELECT COALESCE(SUM(size), 0) FROM TableCache').fetchone()[0]
+            if size != table_cache['size'] or size > max_size:
+                return False
+        keys = [k[0] for k in reader['connection'].execute('SELECT key FROM TableCache')]
+        if tablecache.get_table_key(raw_wikitables[0]) not in keys or \
+                tablecache.get_table_key(raw_wikitables[1]) in keys:
+            return False
+        # a hit gives the parsed wikitable of the parser
+        hit = tablecache.parse_wikitable(reader, raw_wikitables[0], 'Other page', 5)
+        if hit != wikitableparser.wikitable_parser(raw_wikitables[0], 'Other page', 5):
+            return False
+
+        table_cache['connection'].execute("UPDATE CacheVersion SET version = 'other parser'")
+        table_cache['connection'].commit()
+        tablecache.close_table_cache(table_cache)
+        table_cache = tablecache.open_table_cache(filename, max_size)
+        count = table_cache['connection'].execute('SELECT COUNT(*) FROM TableCache').fetchone()[0]
+        tablecache.close_table_cache(table_cache)
+        reader['connection'].close()
+
+    return count == 0 and table_cache['size'] == 0
+
+
+def check_index_cache():
+    """
+    Check that the index cache gives the content of the index, and is rebuilt when the index changes or is
+    corrupted
+
+    :return: bool
+    """
+
+    with tempfile.TemporaryDirectory() as directory:
+        dump_directory = os.path.join(directory, 'dump')
+        os.mkdir(dump_directory)
+        index = None
+        for pages_per_stream in (10, 7, 'corrupted'):
+            if pages_per_stream == 'corrupted':
+                with open(os.path.join(dump_directory, index + multistreamfilehandling.index_cache_suffix),
+                          mode='wb') as f:
+                    f.write(b'not a database')
+            else:
+                write_dump(dump_directory, new_pages(copies=3), pages_per_stream=pages_per_stream)
+            index = [k for k in os.listdir(dump_directory) if '-index' in k and k.endswith('.bz2')][0]
+            offsets = multistreamfilehandling.get_stream_offsets(dump_directory, index)
+            selection = multistreamfilehandling.new_page_selection(titles=['Plain page 20'], page_ids=[1, 1001],
+                                                                   title_regexp='^Ken')
+            selected = multistreamfilehandling.get_selected_pages(dump_directory, index, selection)
+            for with_pages in (False, True):
+                index_cache = multistreamfilehandling.open_index_cache(dump_directory, index, with_pages)
+                if index_cache is None:
+                    return False
+                try:
+                    if multistreamfilehandling.get_stream_offsets(dump_directory, index, index_cache) != offsets:
+                        return False
+                    if with_pages and multistreamfilehandling.get_selected_pages(dump_directory, index, selection,
+                                                                                 index_cache) != selected:
+                        return False
+                    if multistreamfilehandling.get_listed_pages(dump_directory, index, {1, 1001}, index_cache) != \
+                            multistreamfilehandling.get_listed_pages(dump_directory, index, {1, 1001}):
+                        return False
+                finally:
+                    index_cache.close()
+
+    return True
+
+
+if __name__ == "__main__":
+    checks = {'interrupt and resume': check_interrupt_and_resume,
+              'corrupt stream': check_corrupt_stream,
+              'refresh': check_refresh,
+              'compact schema': check_compact_schema,
+              'arrow output': check_arrow_output,
+              'table cache': check_table_cache,
+              'table cache eviction': check_table_cache_eviction,
+              'index cache': check_index_cache}
+    for name, check in checks.items():
+        if check():
+            print("Test '" + name + "' Passed!")
+        else:
+            print("Test '" + name + "' Failed!")
@@ -3,6 +3,7 @@ import os
 import re
 import json
 import collections
+import importlib.util
 
 from ..wikitablestosql import wikitableparser
 
@@ -35,10 +36,27 @@ def extract_col_and_row_span(attrib):
     return span
 
 
-def parsed_to_sql_ready(raw_wikitable_with_meta):
-    wikitabledata = wikitableparser.wikitable_parser(raw_wikitable_with_meta['WikitableData'],
-                                                     raw_wikitable_with_meta['PageName'],
-                                                     raw_wikitable_with_meta['TableId'])
+def load_pure_python_parser():
+    """
+    Load the pure Python wikitable parser module (the compiled module is imported first when it is built)
+
+    :return: module
+    """
+
+    spec = importlib.util.spec_from_file_location('wikitableparser_pure_python',
+                                                  os.path.join(os.path.dirname(wikitableparser.__file__),
+                                                               'wikitableparser.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def parsed_to_sql_ready(raw_wikitable_with_meta, engine='token', parser=wikitableparser):
+    wikitabledata = parser.wikitable_parser(raw_wikitable_with_meta['WikitableData'],
+                                            raw_wikitable_with_meta['PageName'],
+                                            raw_wikitable_with_meta['TableId'],
+                                            engine)
 
     table_name = wikitabledata['pagename'] + '_' + str(wikitabledata['tablecount'])
     table_info = (wikitabledata['pagename'],
@@ -87,17 +105,24 @@ def check_test_file(test_file):
     with open(test_file, mode='r', encoding='UTF-8') as f:
         loaded = json.load(f)
 
+    parsers = [wikitableparser]
+    if wikitableparser.compiled:
+        parsers.append(load_pure_python_parser())
+
     for i in loaded:
         from_file_raw = i['raw']
         from_file_parsed = i['parsed']
-        parsed = parsed_to_sql_ready(from_file_raw)
-
-        if collections.Counter(nested_list_to_nested_tuple(from_file_parsed[0])) \
-                != collections.Counter(nested_list_to_nested_tuple(parsed[0])):
-            return False
-        if collections.Counter(nested_list_to_nested_tuple(from_file_parsed[1])) \
-                != collections.Counter(nested_list_to_nested_tuple(parsed[1])):
-            return False
+        # Every parser engine (compiled and pure Python) must give the expected result
+        for parser in parsers:
+            for engine in wikitableparser.parser_engines:
+                parsed = parsed_to_sql_ready(from_file_raw, engine, parser)
+
+                if collections.Counter(nested_list_to_nested_tuple(from_file_parsed[0])) \
+                        != collections.Counter(nested_list_to_nested_tuple(parsed[0])):
+                    return False
+                if collections.Counter(nested_list_to_nested_tuple(from_file_parsed[1])) \
+                        != collections.Counter(nested_list_to_nested_tuple(parsed[1])):
+                    return False
 
     return True
 
@@ -1,75 +1,332 @@
 
 import os
-import csv
+import re
 import bz2
+import mmap
+import html
+import sqlite3
+from array import array
 
 
-def prepare_parts_using_index(data_directory, file, index, done=0):
+# Index cache: sqlite3 file next to the index holding its parsed content, keyed by the index size and mtime (the
+# pages are only stored when they are looked up)
+index_cache_suffix = '.cache.db'
+index_cache_forms = ['CREATE TABLE IndexFile ( size integer, mtime_ns integer, has_pages integer)',
+                     'CREATE TABLE Streams ( byte_offset integer PRIMARY KEY)',
+                     'CREATE TABLE Pages ( page_id integer, title text, byte_offset integer)']
+# built once the pages are inserted
+index_cache_index_forms = ['CREATE INDEX idx_Pages_page_id ON Pages (page_id)',
+                           'CREATE INDEX idx_Pages_title ON Pages (title)']
+index_cache_batch_size = 100000
+
+# Byte offset at the start of each line of a multistream index
+index_offset_regexp = re.compile(rb'^(\d+):', re.MULTILINE)
+
+
+def iter_index(data_directory, index, chunk_size=1048576):
     """
-    Prepare parts by cutting multistream file according to index.
-    Prepare decompression directory.
+    Read a multistream index (lines of the form offset:page_id:title).
 
     :param data_directory: path as string
-    :param file: filename as string
     :param index: index filename as string
-    :param done: for naming purposes, as int
-    :return: process information as dict
+    :param chunk_size: number of decompressed bytes decoded at a time, as int
+    :return: generator of (byte_offset, page_id, title), title unescaped
     """
 
-    # decompress index
-    decompressed_index_filename = os.path.splitext(index)[0]
+    remainder = b''
     with bz2.open(os.path.join(data_directory, index), mode='rb') as indexf:
-        decompressed_index = indexf.read()
-        with open(decompressed_index_filename, mode='wb') as decomp_index_file:
-            decomp_index_file.write(decompressed_index)
-
-    # parse index
-    byte_offsets = []
-    with open(decompressed_index_filename, encoding='UTF-8') as csv_file:
-        csv_index = csv.reader(csv_file, delimiter=':')
-        for row in csv_index:
-            if len(byte_offsets) == 0:
-                byte_offsets.append(int(row[0]))
-            else:
-                if int(row[0]) != byte_offsets[-1]:
-                    byte_offsets.append(int(row[0]))
-
-    parts_directory = str(done) + 'parts' + '_' + file
-
-    # cut file according to index
-    if parts_directory not in os.listdir():
-        os.mkdir(parts_directory)
-    with open(os.path.join(data_directory, file), mode='rb') as f:
-        for i in range(len(byte_offsets)-1):
-            with open(os.path.join(parts_directory, 'part' + '_' + str(i+1) + '_' + file), mode='wb') as pf:
-                f.seek(byte_offsets[i])
-                data_part = f.read(byte_offsets[i+1] - byte_offsets[i])
-                pf.write(data_part)
-        f.seek(byte_offsets[-1])
-        last_part_name = 'part' + '_' + str(len(byte_offsets)) + '_' + file
-        with open(os.path.join(parts_directory, last_part_name), mode='wb') as lpf:
-            lpf.write(f.read())
-
-    # prepare for decompression
-    decompression_directory = 'decompressed' + '_' + parts_directory
-    if decompression_directory not in os.listdir():
-        os.mkdir(decompression_directory)
-
-    return {'decompressed_index_filename': decompressed_index_filename, 'parts_directory': parts_directory,
-            'last_part_name': last_part_name, 'parts_decompression_directory': decompression_directory}
-
-
-def decompress_part(parts_directory, part_file, parts_decompression_directory):
-    """
-    Decompress one part file.
-
-    :param parts_directory: path as string
-    :param part_file: filename as string
-    :param parts_decompression_directory: path as string
-    :return: filename as string
-    """
-    decompressed_filename = 'decompressed' + '_' + os.path.splitext(part_file)[0]
-    with bz2.open(os.path.join(parts_directory, part_file), mode='rb') as f:
-        with open(os.path.join(parts_decompression_directory, decompressed_filename), mode='wb') as g:
-            g.write(f.read())
-    return decompressed_filename
+        while True:
+            chunk = indexf.read(chunk_size)
+            data = remainder + chunk
+            # complete lines only (all remaining data once the index is read)
+            end = data.rfind(b'\n') + 1 if chunk else len(data)
+            remainder = data[end:]
+            for line in data[:end].decode('UTF-8').split('\n'):
+                if not line:
+                    continue
+                # titles may contain ':'
+                byte_offset, page_id, title = line.split(':', 2)
+                yield int(byte_offset), int(page_id), html.unescape(title) if '&' in title else title
+            if not chunk:
+                break
+
+
+def get_index_key(data_directory, index):
+    """
+    Get the key of an index in its cache.
+
+    :param data_directory: path as string
+    :param index: index filename as string
+    :return: (size, mtime_ns)
+    """
+
+    stat = os.stat(os.path.join(data_directory, index))
+    return stat.st_size, stat.st_mtime_ns
+
+
+def build_index_cache(data_directory, index, cache_filename, with_pages=False):
+    """
+    Parse an index into a new cache file (written next to cache_filename, then moved into place).
+
+    :param data_directory: path as string
+    :param index: index filename as string
+    :param cache_filename: path as string
+    :param with_pages: True to store the pages (needed for page lookups) besides the streams, as bool
+    :return:
+    """
+
+    temp_filename = cache_filename + '.tmp'
+    if os.path.exists(temp_filename):
+        os.remove(temp_filename)
+    connection = sqlite3.connect(temp_filename)
+    try:
+        cursor = connection.cursor()
+        # the file is only moved into place once complete
+        cursor.execute('PRAGMA journal_mode=OFF')
+        cursor.execute('PRAGMA synchronous=OFF')
+        for i in index_cache_forms:
+            cursor.execute(i)
+        cursor.execute('INSERT INTO IndexFile VALUES (?, ?, ?)',
+                       get_index_key(data_directory, index) + (int(with_pages),))
+        if with_pages:
+            pages = []
+            byte_offsets = array('q')
+            for byte_offset, page_id, title in iter_index(data_directory, index):
+                pages.append((page_id, title, byte_offset))
+                if len(byte_offsets) == 0 or byte_offset != byte_offsets[-1]:
+                    byte_offsets.append(byte_offset)
+                if len(pages) >= index_cache_batch_size:
+                    cursor.executemany('INSERT INTO Pages VALUES (?, ?, ?)', pages)
+                    pages = []
+            cursor.executemany('INSERT INTO Pages VALUES (?, ?, ?)', pages)
+            # indexes built in one pass rather than maintained row by row
+            for i in index_cache_index_forms:
+                cursor.execute(i)
+        else:
+            byte_offsets = get_stream_offsets(data_directory, index)
+        cursor.executemany('INSERT OR IGNORE INTO Streams VALUES (?)', ((k,) for k in byte_offsets))
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(temp_filename, cache_filename)
+
+
+def open_index_cache(data_directory, index, with_pages=False):
+    """
+    Open the cache of an index, (re)building it if it is missing or stale (or without pages if with_pages).
+
+    :param data_directory: path as string
+    :param index: index filename as string
+    :param with_pages: True if pages are looked up in the cache, as bool
+    :return: sqlite3 connection, None if the cache cannot be written
+    """
+
+    cache_filename = os.path.join(data_directory, index + index_cache_suffix)
+    try:
+        if os.path.exists(cache_filename):
+            connection = sqlite3.connect(cache_filename)
+            try:
+                key = connection.execute('SELECT size, mtime_ns, has_pages FROM IndexFile').fetchone()
+            except sqlite3.DatabaseError:
+                key = None
+            if key is not None and key[:2] == get_index_key(data_directory, index) and (key[2] or not with_pages):
+                return connection
+            connection.close()
+        build_index_cache(data_directory, index, cache_filename, with_pages)
+        return sqlite3.connect(cache_filename)
+    except (OSError, sqlite3.Error):
+        # e.g. read-only dump directory
+        return None
+
+
+def get_stream_offsets(data_directory, index, index_cache=None, chunk_size=1048576):
+    """
+    Get the starting byte offset of every stream listed in a multistream index.
+
+    :param data_directory: path as string
+    :param index: index filename as string
+    :param index_cache: sqlite3 connection to the index cache (see open_index_cache), None to parse the index
+    :param chunk_size: number of decompressed bytes parsed at a time, as int
+    :return: byte offsets as array('q')
+    """
+
+    if index_cache is not None:
+        return array('q', (k[0] for k in index_cache.execute('SELECT byte_offset FROM Streams ORDER BY byte_offset')))
+
+    # decompress and parse the index chunk by chunk, only keeping distinct offsets
+    byte_offsets = array('q')
+    remainder = b''
+    with bz2.open(os.path.join(data_directory, index), mode='rb') as indexf:
+        while True:
+            chunk = indexf.read(chunk_size)
+            data = remainder + chunk
+            # complete lines only (all remaining data once the index is read)
+            end = data.rfind(b'\n') + 1 if chunk else len(data)
+            remainder = data[end:]
+            # the pages of a stream are listed together, duplicates are removed before conversion
+            for byte_offset in dict.fromkeys(index_offset_regexp.findall(data, 0, end)):
+                byte_offset = int(byte_offset)
+                if len(byte_offsets) == 0 or byte_offset != byte_offsets[-1]:
+                    byte_offsets.append(byte_offset)
+            if not chunk:
+                break
+
+    return byte_offsets
+
+
+def new_page_selection(titles=None, page_ids=None, title_regexp=None):
+    """
+    Create a page selection (a page is selected if its title or id is listed or if its title matches title_regexp).
+
+    :param titles: iterable of titles (None for no title)
+    :param page_ids: iterable of page ids as int (None for no page id)
+    :param title_regexp: regular expression searched in titles as string (None for no regular expression)
+    :return: page selection as dict
+    """
+
+    return {'titles': frozenset(titles or ()),
+            'page_ids': frozenset(page_ids or ()),
+            'title_regexp': None if title_regexp is None else re.compile(title_regexp)}
+
+
+def is_page_selected(page_selection, page_id, title):
+    """
+    Check if a page is selected.
+
+    :param page_selection: page selection as dict (see new_page_selection)
+    :param page_id: int
+    :param title: string
+    :return: bool
+    """
+
+    return page_id in page_selection['page_ids'] or title in page_selection['titles'] or \
+        (page_selection['title_regexp'] is not None and page_selection['title_regexp'].search(title) is not None)
+
+
+def get_selected_pages(data_directory, index, page_selection, index_cache=None):
+    """
+    Find the selected pages in a multistream index.
+
+    :param data_directory: path as string
+    :param index: index filename as string
+    :param page_selection: page selection as dict (see new_page_selection)
+    :param index_cache: sqlite3 connection to the index cache (see open_index_cache), None to parse the index
+    :return: ids of the selected pages by stream byte offset, as dict of sets
+    """
+
+    selected_pages = {}
+    if index_cache is None:
+        for byte_offset, page_id, title in iter_index(data_directory, index):
+            if is_page_selected(page_selection, page_id, title):
+                selected_pages.setdefault(byte_offset, set()).add(page_id)
+        return selected_pages
+
+    queries = []
+    for column, values in (('title', list(page_selection['titles'])), ('page_id', list(page_selection['page_ids']))):
+        # at most 500 parameters per query
+        for k in range(0, len(values), 500):
+            chunk = values[k:k + 500]
+            queries.append(('SELECT page_id, byte_offset FROM Pages WHERE ' + column + ' IN (' +
+                            ', '.join('?' * len(chunk)) + ')', chunk))
+    if page_selection['title_regexp'] is not None:
+        index_cache.create_function('REGEXP', 2,
+                                    lambda pattern, title: page_selection['title_regexp'].search(title) is not None)
+        queries.append(('SELECT page_id, byte_offset FROM Pages WHERE title REGEXP ?',
+                        [page_selection['title_regexp'].pattern]))
+    for query, parameters in queries:
+        for page_id, byte_offset in index_cache.execute(query, parameters):
+            selected_pages.setdefault(byte_offset, set()).add(page_id)
+
+    return selected_pages
+
+
+def get_listed_pages(data_directory, index, page_ids, index_cache=None):
+    """
+    Find the pages of a multistream index whose ids are in page_ids, reading the index (or its cached pages) once.
+
+    :param data_directory: path as string
+    :param index: index filename as string
+    :param page_ids: container of page ids as int (e.g. a dict keyed by page id)
+    :param index_cache: sqlite3 connection to the index cache (see open_index_cache), the index is parsed if None
+                        or if the cache holds no pages
+    :return: ids of the listed pages by stream byte offset, as dict of sets
+    """
+
+    if index_cache is not None and index_cache.execute('SELECT has_pages FROM IndexFile').fetchone()[0]:
+        pages = index_cache.execute('SELECT byte_offset, page_id FROM Pages')
+    else:
+        pages = ((byte_offset, page_id) for byte_offset, page_id, title in iter_index(data_directory, index))
+
+    listed_pages = {}
+    for byte_offset, page_id in pages:
+        if page_id in page_ids:
+            listed_pages.setdefault(byte_offset, set()).add(page_id)
+    return listed_pages
+
+
+def get_streams(data_directory, file, index, index_cache=None):
+    """
+    Get the location of every stream of a multistream file according to its index.
+
+    :param data_directory: path as string
+    :param file: filename as string
+    :param index: index filename as string
+    :param index_cache: sqlite3 connection to the index cache (see open_index_cache), None to parse the index
+    :return: list of streams where each stream is of the form: (byte_offset, length, is_last)
+    """
+
+    byte_offsets = get_stream_offsets(data_directory, index, index_cache)
+    # the last stream runs to the end of the file (it also holds the closing </mediawiki> stream)
+    byte_offsets.append(os.path.getsize(os.path.join(data_directory, file)))
+
+    streams = []
+    for i in range(len(byte_offsets)-1):
+        streams.append((byte_offsets[i], byte_offsets[i+1] - byte_offsets[i], i == len(byte_offsets) - 2))
+    return streams
+
+
+def map_multistream_file(file):
+    """
+    Memory-map a multistream file (read-only).
+
+    :param file: path as string
+    :return: mmap object
+    """
+
+    with open(file, mode='rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def slice_stream(mapped_file, byte_offset, length):
+    """
+    Get one compressed stream of a memory-mapped multistream file without copying it.
+
+    :param mapped_file: mmap object
+    :param byte_offset: int
+    :param length: int
+    :return: compressed stream as memoryview
+    """
+
+    return memoryview(mapped_file)[byte_offset:byte_offset + length]
+
+
+def iter_decompress_stream(compressed_stream, chunk_size=65536):
+    """
+    Decompress one stream (or several consecutive streams) held in memory chunk by chunk.
+
+    :param compressed_stream: bytes-like object
+    :param chunk_size: number of compressed bytes decompressed at a time, as int
+    :return: generator of decompressed xml chunks (bytes)
+    """
+
+    decompressor = bz2.BZ2Decompressor()
+    for k in range(0, len(compressed_stream), chunk_size):
+        data = compressed_stream[k:k + chunk_size]
+        while len(data) != 0:
+            # next stream
+            if decompressor.eof:
+                decompressor = bz2.BZ2Decompressor()
+            decompressed = decompressor.decompress(data)
+            if decompressed:
+                yield decompressed
+            data = decompressor.unused_data if decompressor.eof else b''
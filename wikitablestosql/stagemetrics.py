@@ -0,0 +1,180 @@
+
+import time
+import json
+
+
+# Processing stages, in pipeline order
+stages = ('index', 'slice', 'decompress', 'xml_parse', 'table_scan', 'table_parse', 'write')
+
+
+def new_metrics():
+    """
+    Create the metrics of the stages run by one thread or one task.
+
+    :return: dict with 'stages' (seconds, bytes_in, bytes_out and items by stage, as dict) and 'nested' (time spent
+             in the nested stages of each running stage, as list)
+    """
+
+    return {'stages': {stage: {'seconds': 0.0, 'bytes_in': 0, 'bytes_out': 0, 'items': 0} for stage in stages},
+            'nested': []}
+
+
+def start_stage(metrics):
+    """
+    Start timing a stage (stages may be nested, the time of a stage excludes that of its nested stages).
+
+    :param metrics: dict (see new_metrics), None if metrics are not collected
+    :return: start time to pass to end_stage
+    """
+
+    if metrics is None:
+        return None
+    metrics['nested'].append(0.0)
+    return time.perf_counter()
+
+
+def end_stage(metrics, stage, start, bytes_in=0, bytes_out=0, items=0):
+    """
+    Stop timing a stage.
+
+    :param metrics: dict (see new_metrics), None if metrics are not collected
+    :param stage: stage name as string (see stages)
+    :param start: start time returned by start_stage
+    :param bytes_in: int
+    :param bytes_out: int
+    :param items: int
+    :return:
+    """
+
+    if metrics is None:
+        return
+    elapsed = time.perf_counter() - start
+    nested = metrics['nested'].pop()
+    if metrics['nested']:
+        metrics['nested'][-1] += elapsed
+    add_stage_counts(metrics, stage, bytes_in, bytes_out, items)
+    metrics['stages'][stage]['seconds'] += elapsed - nested
+
+
+def add_stage_counts(metrics, stage, bytes_in=0, bytes_out=0, items=0):
+    """
+    Add counts to a stage without timing it.
+
+    :param metrics: dict (see new_metrics), None if metrics are not collected
+    :param stage: stage name as string (see stages)
+    :param bytes_in: int
+    :param bytes_out: int
+    :param items: int
+    :return:
+    """
+
+    if metrics is None:
+        return
+    counts = metrics['stages'][stage]
+    counts['bytes_in'] += bytes_in
+    counts['bytes_out'] += bytes_out
+    counts['items'] += items
+
+
+def iter_timed(metrics, stage, iterable, measure=None):
+    """
+    Time the production of each element of iterable as stage.
+
+    :param metrics: dict (see new_metrics), None if metrics are not collected
+    :param stage: stage name as string (see stages)
+    :param iterable: iterable
+    :param measure: function giving the bytes_out of an element (None to not count bytes)
+    :return: generator of the elements of iterable
+    """
+
+    if metrics is None:
+        yield from iterable
+        return
+
+    iterator = iter(iterable)
+    while True:
+        start = start_stage(metrics)
+        try:
+            element = next(iterator)
+        except StopIteration:
+            end_stage(metrics, stage, start)
+            return
+        end_stage(metrics, stage, start, bytes_out=0 if measure is None else measure(element))
+        yield element
+
+
+def add_metrics(total, metrics):
+    """
+    Add the stage metrics of metrics to total.
+
+    :param total: dict (see new_metrics)
+    :param metrics: dict (see new_metrics)
+    :return:
+    """
+
+    for stage, counts in metrics['stages'].items():
+        for name, value in counts.items():
+            total['stages'][stage][name] += value
+
+
+def get_snapshot(metrics_list, elapsed, queues):
+    """
+    Summarize metrics collected by several threads.
+
+    :param metrics_list: list of dict (see new_metrics)
+    :param elapsed: wall-clock seconds since the start of the run, as float
+    :param queues: queue depths by queue name, as dict
+    :return: dict, the seconds of the stages run by the pool workers being summed over the workers
+    """
+
+    snapshot_stages = {}
+    for stage in stages:
+        counts = {name: sum(k['stages'][stage][name] for k in metrics_list)
+                  for name in ('seconds', 'bytes_in', 'bytes_out', 'items')}
+        counts['items_per_second'] = counts['items'] / counts['seconds'] if counts['seconds'] else 0.0
+        counts['mb_in_per_second'] = counts['bytes_in'] / 1e6 / counts['seconds'] if counts['seconds'] else 0.0
+        snapshot_stages[stage] = counts
+
+    pages = snapshot_stages['xml_parse']['items']
+    tables = snapshot_stages['table_parse']['items']
+    return {'elapsed': elapsed,
+            'pages': pages,
+            'tables': tables,
+            'pages_per_second': pages / elapsed if elapsed else 0.0,
+            'tables_per_second': tables / elapsed if elapsed else 0.0,
+            'queues': dict(queues),
+            'stages': snapshot_stages}
+
+
+def write_snapshot(file, snapshot):
+    """
+    Write a snapshot as one JSON line.
+
+    :param file: text file object
+    :param snapshot: dict (see get_snapshot)
+    :return:
+    """
+
+    file.write(json.dumps(snapshot, sort_keys=True) + '\n')
+    file.flush()
+
+
+def format_summary(snapshot):
+    """
+    Format a snapshot as a table of stages.
+
+    :param snapshot: dict (see get_snapshot)
+    :return: list of lines
+    """
+
+    total_seconds = sum(counts['seconds'] for counts in snapshot['stages'].values())
+    lines = ['{:<12}{:>12}{:>8}{:>12}{:>12}{:>14}'.format('stage', 'seconds', 'share', 'items', 'items/s', 'MB in/s')]
+    for stage, counts in snapshot['stages'].items():
+        share = 100 * counts['seconds'] / total_seconds if total_seconds else 0.0
+        lines.append('{:<12}{:>12.2f}{:>7.1f}%{:>12}{:>12.0f}{:>14.2f}'.format(
+            stage, counts['seconds'], share, counts['items'], counts['items_per_second'],
+            counts['mb_in_per_second']))
+    lines.append('{:.1f} s, {} pages ({:.0f}/s), {} tables ({:.0f}/s)'.format(
+        snapshot['elapsed'], snapshot['pages'], snapshot['pages_per_second'], snapshot['tables'],
+        snapshot['tables_per_second']))
+    return lines
@@ -0,0 +1,215 @@
+
+import json
+import zlib
+import sqlite3
+import hashlib
+
+from . import wikitableparser
+
+
+# Cache of parsed wikitables keyed by a hash of their raw text, with least recently used eviction, valid for the
+# parser and the value format it records (the cache is cleared when either changes)
+table_cache_forms = ['CREATE TABLE IF NOT EXISTS TableCache '
+                     '( key blob PRIMARY KEY, value blob, size integer, last_used integer)',
+                     'CREATE INDEX IF NOT EXISTS TableCache_last_used ON TableCache (last_used)',
+                     'CREATE TABLE IF NOT EXISTS CacheVersion ( version text)']
+# Version of the format of the cached values
+table_cache_format = 1
+# Share of the maximum size kept when entries are evicted
+eviction_ratio = 0.9
+
+
+def get_cache_version():
+    """
+    Get the version of the cache entries: format of the values and fingerprint of the wikitable parser module
+    (any change to the parser invalidates the cache).
+
+    :return: string
+    """
+
+    with open(wikitableparser.__file__, mode='rb') as f:
+        fingerprint = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+    return str(table_cache_format) + ':' + fingerprint
+
+
+def get_table_key(raw_wikitable):
+    """
+    Get the cache key of a raw wikitable.
+
+    :param raw_wikitable: string
+    :return: bytes
+    """
+
+    return hashlib.blake2b(raw_wikitable.encode('UTF-8'), digest_size=16).digest()
+
+
+def encode_wikitable(wikitabledata):
+    """
+    Encode a parsed wikitable for the cache (the page name and table count are not stored).
+
+    :param wikitabledata: parsed wikitable as dict
+    :return: bytes
+    """
+
+    content = {k: v for k, v in wikitabledata.items() if k != 'pagename' and k != 'tablecount'}
+    return zlib.compress(json.dumps(content, separators=(',', ':')).encode('UTF-8'))
+
+
+def decode_wikitable(value, page_name, table_count):
+    """
+    Decode a parsed wikitable from the cache.
+
+    :param value: bytes
+    :param page_name: string
+    :param table_count: int
+    :return: parsed wikitable as dict
+    """
+
+    wikitabledata = {'pagename': page_name, 'tablecount': table_count}
+    wikitabledata.update(json.loads(zlib.decompress(value).decode('UTF-8')))
+    return wikitabledata
+
+
+# Worker side: lookups only, the new entries are returned to the writer
+def open_table_cache_reader(filename):
+    """
+    Open a table cache for lookups (read-only).
+
+    :param filename: path as string
+    :return: lookup state as dict
+    """
+
+    connection = sqlite3.connect('file:' + filename + '?mode=ro', uri=True)
+    return {'connection': connection, 'updates': new_table_cache_updates()}
+
+
+def new_table_cache_updates():
+    """
+    Create the record of the cache lookups of a worker.
+
+    :return: dict with 'hits' (keys found in the cache, as list) and 'new' ((key, value) of the wikitables
+             parsed on a miss, as list)
+    """
+
+    return {'hits': [], 'new': []}
+
+
+def parse_wikitable(table_cache, raw_wikitable, page_name, table_count, engine='token'):
+    """
+    Get a parsed wikitable from the cache, parse it on a miss.
+
+    :param table_cache: lookup state as dict (see open_table_cache_reader)
+    :param raw_wikitable: string
+    :param page_name: string
+    :param table_count: int
+    :param engine: parser engine (see wikitableparser.parser_engines)
+    :return: parsed wikitable as dict
+    """
+
+    key = get_table_key(raw_wikitable)
+    value = table_cache['connection'].execute('SELECT value FROM TableCache WHERE key = ?', (key,)).fetchone()
+    if value is not None:
+        table_cache['updates']['hits'].append(key)
+        return decode_wikitable(value[0], page_name, table_count)
+
+    wikitabledata = wikitableparser.wikitable_parser(raw_wikitable, page_name, table_count, engine)
+    # wikitables with a parsing problem are not cached
+    if isinstance(wikitabledata, dict):
+        table_cache['updates']['new'].append((key, encode_wikitable(wikitabledata)))
+    return wikitabledata
+
+
+def take_table_cache_updates(table_cache):
+    """
+    Get the cache lookups recorded since the last call.
+
+    :param table_cache: lookup state as dict (see open_table_cache_reader)
+    :return: dict (see new_table_cache_updates)
+    """
+
+    updates = table_cache['updates']
+    table_cache['updates'] = new_table_cache_updates()
+    return updates
+
+
+# Writer side: single writer of the cache
+def open_table_cache(filename, max_size):
+    """
+    Open (create if needed) a table cache for writing, clearing it if its entries were made by another parser.
+
+    :param filename: path as string
+    :param max_size: maximum total size of the cached values in bytes, as int
+    :return: writer state as dict
+    """
+
+    # opened before the output writer thread, which then is its only user
+    connection = sqlite3.connect(filename, check_same_thread=False)
+    # readers are not blocked by the writer
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    for i in table_cache_forms:
+        connection.execute(i)
+    # entries of another parser or value format are discarded
+    version = get_cache_version()
+    if connection.execute('SELECT version FROM CacheVersion').fetchall() != [(version,)]:
+        connection.execute('DELETE FROM TableCache')
+        connection.execute('DELETE FROM CacheVersion')
+        connection.execute('INSERT INTO CacheVersion VALUES (?)', (version,))
+    connection.commit()
+    size, last_used = connection.execute('SELECT COALESCE(SUM(size), 0), COALESCE(MAX(last_used), 0) '
+                                         'FROM TableCache').fetchone()
+
+    return {'connection': connection, 'max_size': max_size, 'size': size, 'clock': last_used,
+            'hits': 0, 'misses': 0}
+
+
+def store_table_cache_updates(table_cache, updates):
+    """
+    Store the new entries of a worker, mark its hits as recently used and evict the least recently used
+    entries once the cache exceeds its maximum size.
+
+    :param table_cache: writer state as dict (see open_table_cache)
+    :param updates: dict (see new_table_cache_updates)
+    :return:
+    """
+
+    table_cache['hits'] += len(updates['hits'])
+    table_cache['misses'] += len(updates['new'])
+    table_cache['clock'] += 1
+    clock = table_cache['clock']
+    cursor = table_cache['connection'].cursor()
+
+    cursor.executemany('UPDATE TableCache SET last_used = ? WHERE key = ?', ((clock, k) for k in updates['hits']))
+    for key, value in updates['new']:
+        # the same wikitable may be parsed by several workers before it is cached
+        previous = cursor.execute('SELECT size FROM TableCache WHERE key = ?', (key,)).fetchone()
+        if previous is not None:
+            table_cache['size'] -= previous[0]
+        cursor.execute('INSERT OR REPLACE INTO TableCache VALUES (?, ?, ?, ?)', (key, value, len(value), clock))
+        table_cache['size'] += len(value)
+
+    if table_cache['size'] > table_cache['max_size']:
+        target = table_cache['max_size'] * eviction_ratio
+        evicted = []
+        # least recently used first (last_used index), only the evicted entries are read
+        entries = table_cache['connection'].execute('SELECT key, size FROM TableCache ORDER BY last_used')
+        for key, size in entries:
+            if table_cache['size'] <= target:
+                break
+            evicted.append((key,))
+            table_cache['size'] -= size
+        entries.close()
+        cursor.executemany('DELETE FROM TableCache WHERE key = ?', evicted)
+
+    table_cache['connection'].commit()
+
+
+def close_table_cache(table_cache):
+    """
+    Close a table cache (writer side).
+
+    :param table_cache: writer state as dict (see open_table_cache)
+    :return:
+    """
+
+    table_cache['connection'].close()
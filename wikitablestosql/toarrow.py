@@ -0,0 +1,114 @@
+from importlib import util
+
+from . import tosql
+
+
+pyarrow_check = util.find_spec('pyarrow')
+if pyarrow_check is not None:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+else:
+    pa = None
+    pq = None
+
+
+file_extensions = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+
+def get_columns():
+    """
+    Get the columns of the WikitableInformation and WikitableData tables (same as in the sqlite3 database).
+
+    :return: list of (column name, arrow type) by table name, as dict
+    """
+
+    return {'WikitableInformation': [('page_name', pa.string()), ('table_name', pa.string()),
+                                     ('table_attributes', pa.string()), ('caption', pa.string()),
+                                     ('caption_attributes', pa.string()), ('page_id', pa.int64())],
+            'WikitableData': [('table_name', pa.string()), ('row', pa.int32()), ('col', pa.int32()),
+                              ('cell_data', pa.string()), ('cell_attributes', pa.string()),
+                              ('is_header', pa.int8()), ('row_span', pa.int32()), ('col_span', pa.int32())]}
+
+
+def get_output_filenames(base, output_format):
+    """
+    Determine the output filename of each table.
+
+    :param base: filename without extension as string
+    :param output_format: 'parquet' or 'arrow'
+    :return: filename by table name, as dict
+    """
+
+    return {table: base + '.' + table + file_extensions[output_format]
+            for table in ('WikitableInformation', 'WikitableData')}
+
+
+# Output backend interface (see also tosql): open_writer, write_wikitables, commit, close_writer
+def open_writer(base, output_format='parquet', compression='zstd'):
+    """
+    Open one columnar file per table (Parquet or Arrow IPC).
+
+    :param base: filename without extension as string
+    :param output_format: 'parquet' or 'arrow'
+    :param compression: compression codec as string
+    :return: writer state as dict
+    """
+
+    if pa is None:
+        raise ImportError('pyarrow is required to write ' + output_format + ' files')
+
+    writers = {}
+    schemas = {}
+    for table, filename in get_output_filenames(base, output_format).items():
+        schemas[table] = pa.schema(get_columns()[table])
+        if output_format == 'parquet':
+            writers[table] = pq.ParquetWriter(filename, schemas[table], compression=compression)
+        else:
+            writers[table] = pa.ipc.new_file(filename, schemas[table],
+                                             options=pa.ipc.IpcWriteOptions(compression=compression))
+
+    return {'writers': writers, 'schemas': schemas, 'rows': tosql.new_row_buffers()}
+
+
+def write_wikitables(writer_state, wikitabledata_list, stream=None, page_changes=None):
+    """
+    Buffer the rows of a list of wikitables until the next commit.
+
+    :param writer_state: writer state as dict
+    :param wikitabledata_list: list of wikitabledata (each wikitabledata is a dict)
+    :param stream: unused (the progress of the ingestion is only recorded in sqlite3 databases)
+    :param page_changes: unused (page revisions are only recorded in sqlite3 databases)
+    :return:
+    """
+
+    for i in wikitabledata_list:
+        tosql.append_wikitable_rows(writer_state['rows'], i)
+
+
+def commit(writer_state):
+    """
+    Write the buffered rows as one row group (Parquet) or record batch (Arrow IPC) per table.
+
+    :param writer_state: writer state as dict
+    :return:
+    """
+
+    for table, rows in writer_state['rows'].items():
+        if len(rows) == 0:
+            continue
+        schema = writer_state['schemas'][table]
+        columns = [pa.array(column, type=schema.field(k).type) for k, column in enumerate(zip(*rows))]
+        writer_state['writers'][table].write_table(pa.Table.from_arrays(columns, schema=schema))
+    writer_state['rows'] = tosql.new_row_buffers()
+
+
+def close_writer(writer_state):
+    """
+    Close the files (uncommitted rows are discarded).
+
+    :param writer_state: writer state as dict
+    :return:
+    """
+
+    for writer in writer_state['writers'].values():
+        writer.close()
@@ -32,72 +32,524 @@ def extract_col_and_row_span(attrib):
     return span
 
 
-# Create the two tables
-def sql_table_creation(database):
+# Bulk-load settings (per connection, except journal_mode) and the settings restored after loading
+fast_load_pragmas = ['PRAGMA journal_mode=WAL', 'PRAGMA synchronous=OFF', 'PRAGMA cache_size=-1048576',
+                     'PRAGMA temp_store=MEMORY']
+safe_pragmas = ['PRAGMA journal_mode=DELETE', 'PRAGMA synchronous=FULL']
+
+# Schemas: 'default' repeats the table name in every cell, 'compact' uses integer table ids
+# and stores row attributes once per row
+table_forms = {
+    'default': ['CREATE TABLE WikitableInformation '
+                '( page_name text, table_name text, table_attributes text, caption text, '
+                'caption_attributes text, page_id integer)',
+                'CREATE TABLE WikitableData '
+                '( table_name text, row int, col int, cell_data text, cell_attributes text, '
+                'is_header integer, row_span integer, col_span integer)'],
+    'compact': ['CREATE TABLE WikitableInformation '
+                '( table_id integer PRIMARY KEY, page_name text, table_index integer, table_attributes text, '
+                'caption text, caption_attributes text, page_id integer)',
+                'CREATE TABLE WikitableRows '
+                '( table_id integer REFERENCES WikitableInformation (table_id), row integer, row_attributes text)',
+                'CREATE TABLE WikitableData '
+                '( table_id integer REFERENCES WikitableInformation (table_id), row integer, col integer, '
+                'cell_data text, cell_attributes text, is_header integer, row_span integer, col_span integer)']}
+
+insert_forms = {
+    'default': {'WikitableInformation': 'INSERT INTO WikitableInformation VALUES (?, ?, ?, ?, ?, ?)',
+                'WikitableData': 'INSERT INTO WikitableData VALUES (?, ?, ?, ?, ?, ?, ?, ?)'},
+    'compact': {'WikitableInformation': 'INSERT INTO WikitableInformation VALUES (?, ?, ?, ?, ?, ?, ?)',
+                'WikitableRows': 'INSERT INTO WikitableRows VALUES (?, ?, ?)',
+                'WikitableData': 'INSERT INTO WikitableData VALUES (?, ?, ?, ?, ?, ?, ?, ?)'}}
+
+index_forms = {
+    'default': {'WikitableData_table_name_row_col': 'CREATE INDEX IF NOT EXISTS WikitableData_table_name_row_col '
+                                                    'ON WikitableData (table_name, row, col)',
+                'WikitableInformation_page_name': 'CREATE INDEX IF NOT EXISTS WikitableInformation_page_name '
+                                                  'ON WikitableInformation (page_name)',
+                'WikitableInformation_page_id': 'CREATE INDEX IF NOT EXISTS WikitableInformation_page_id '
+                                                'ON WikitableInformation (page_id)'},
+    'compact': {'WikitableData_table_id_row_col': 'CREATE INDEX IF NOT EXISTS WikitableData_table_id_row_col '
+                                                  'ON WikitableData (table_id, row, col)',
+                'WikitableRows_table_id_row': 'CREATE INDEX IF NOT EXISTS WikitableRows_table_id_row '
+                                              'ON WikitableRows (table_id, row)',
+                'WikitableInformation_page_name': 'CREATE INDEX IF NOT EXISTS WikitableInformation_page_name '
+                                                  'ON WikitableInformation (page_name)',
+                'WikitableInformation_page_id': 'CREATE INDEX IF NOT EXISTS WikitableInformation_page_id '
+                                                'ON WikitableInformation (page_id)'}}
+
+# Progress of the ingestion: streams whose rows are committed (same for both schemas), by page filter
+# (see wikitableprocessing.get_page_filter_key)
+progress_form = 'CREATE TABLE IF NOT EXISTS IngestedStreams ' \
+                '( dump_file text, byte_offset integer, page_filter text, ' \
+                'PRIMARY KEY (dump_file, byte_offset, page_filter))'
+
+# Revision of the pages with wikitables (pages whose revision is unchanged are not parsed again)
+page_revisions_form = 'CREATE TABLE IF NOT EXISTS PageRevisions ' \
+                      '( page_id integer PRIMARY KEY, page_name text, revision_id integer)'
+
+# Deletion of the rows of a page by page id
+delete_forms = {
+    'default': ['DELETE FROM WikitableData WHERE table_name IN '
+                '(SELECT table_name FROM WikitableInformation WHERE page_id = ?)',
+                'DELETE FROM WikitableInformation WHERE page_id = ?'],
+    'compact': ['DELETE FROM WikitableData WHERE table_id IN '
+                '(SELECT table_id FROM WikitableInformation WHERE page_id = ?)',
+                'DELETE FROM WikitableRows WHERE table_id IN '
+                '(SELECT table_id FROM WikitableInformation WHERE page_id = ?)',
+                'DELETE FROM WikitableInformation WHERE page_id = ?']}
+
+# Deletion of the rows of the other pages with a page name (parameters: page name, page id). Titles are unique in a
+# dump, so these pages were moved or removed since the previous dump (in the default schema, their table names are
+# those of the tables of the page with this name)
+delete_title_forms = {
+    'default': ['DELETE FROM WikitableData WHERE table_name IN '
+                '(SELECT table_name FROM WikitableInformation WHERE page_name = ?1 AND page_id != ?2)',
+                'DELETE FROM WikitableInformation WHERE page_name = ?1 AND page_id != ?2'],
+    'compact': ['DELETE FROM WikitableData WHERE table_id IN '
+                '(SELECT table_id FROM WikitableInformation WHERE page_name = ?1 AND page_id != ?2)',
+                'DELETE FROM WikitableRows WHERE table_id IN '
+                '(SELECT table_id FROM WikitableInformation WHERE page_name = ?1 AND page_id != ?2)',
+                'DELETE FROM WikitableInformation WHERE page_name = ?1 AND page_id != ?2']}
+
+
+# Create the tables
+def sql_table_creation(database, schema='default'):
     """Create sql tables"""
 
     sql_connection = sqlite3.connect(database)
     sql_cursor = sql_connection.cursor()
 
-    # Table of table information creation
-    sql_form = 'CREATE TABLE WikitableInformation ' \
-               '( page_name text, table_name text, table_attributes text, caption text, ' \
-               'caption_attributes text)'
-    sql_cursor.execute(sql_form)
-
-    # Table of tabular data creation
-    sql_form = 'CREATE TABLE WikitableData ' \
-               '( table_name text, row int, col int, cell_data text, cell_attributes text, ' \
-               'is_header integer, row_span integer, col_span integer)'
-    sql_cursor.execute(sql_form)
+    for sql_form in table_forms[schema]:
+        sql_cursor.execute(sql_form)
+    sql_cursor.execute(progress_form)
+    sql_cursor.execute(page_revisions_form)
 
     sql_connection.commit()
     sql_connection.close()
 
 
-def wikitable_data_to_sql(wikitabledata, sql_cursor):
+def get_schema(database):
     """
-    Insertion of wikitable information and cell data into sql database via given cursor.
+    Determine the schema of an existing database.
+
+    :param database: path as string
+    :return: 'compact' or 'default'
+    """
+
+    sql_connection = sqlite3.connect(database)
+    compact = sql_connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND "
+                                     "name = 'WikitableRows'").fetchone()
+    sql_connection.close()
+    if compact is not None:
+        return 'compact'
+    return 'default'
+
+
+def has_progress_table(database):
+    """
+    Check if an existing database records the progress of the ingestion (databases created before it was
+    recorded do not).
+
+    :param database: path as string
+    :return: bool
+    """
+
+    sql_connection = sqlite3.connect(database)
+    progress = sql_connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND "
+                                      "name = 'IngestedStreams'").fetchone()
+    sql_connection.close()
+    return progress is not None
+
+
+def has_page_ids(database):
+    """
+    Check if an existing database records the page id of its wikitables (databases created before it was
+    recorded do not).
+
+    :param database: path as string
+    :return: bool
+    """
+
+    sql_connection = sqlite3.connect(database)
+    columns = [k[1] for k in sql_connection.execute('PRAGMA table_info(WikitableInformation)')]
+    sql_connection.close()
+    return 'page_id' in columns
+
+
+def get_ingested_streams(database, page_filter_keys):
+    """
+    Get the streams already ingested with one of the given page filters.
+
+    :param database: path as string
+    :param page_filter_keys: iterable of page filter keys (see wikitableprocessing.get_page_filter_key)
+    :return: set of (dump_file, byte_offset)
+    """
+
+    page_filter_keys = list(page_filter_keys)
+    sql_connection = sqlite3.connect(database)
+    streams = set(sql_connection.execute('SELECT dump_file, byte_offset FROM IngestedStreams WHERE page_filter IN (' +
+                                         ', '.join('?' * len(page_filter_keys)) + ')', page_filter_keys))
+    sql_connection.close()
+    return streams
+
+
+def get_page_revisions(database):
+    """
+    Get the revision of the pages with wikitables in an existing database.
+
+    :param database: path as string
+    :return: revision id by page id, as dict (empty if the database does not record revisions)
+    """
+
+    sql_connection = sqlite3.connect(database)
+    try:
+        revisions = dict(sql_connection.execute('SELECT page_id, revision_id FROM PageRevisions'))
+    except sqlite3.OperationalError:
+        revisions = {}
+    sql_connection.close()
+    return revisions
+
+
+def delete_page_rows(sql_cursor, schema, page_ids):
+    """
+    Delete the rows and the revision of pages (by page id).
 
-    :param wikitabledata: wikitable data as dict
     :param sql_cursor: sqlite3 cursor object
+    :param schema: 'default' or 'compact'
+    :param page_ids: list of page ids (int)
+    :return:
+    """
+
+    for i in delete_forms[schema]:
+        sql_cursor.executemany(i, ((k,) for k in page_ids))
+    # at most 500 parameters per query
+    for k in range(0, len(page_ids), 500):
+        chunk = page_ids[k:k + 500]
+        sql_cursor.execute('DELETE FROM PageRevisions WHERE page_id IN (' + ', '.join('?' * len(chunk)) + ')', chunk)
+
+
+def delete_pages(database, page_ids):
+    """
+    Delete the rows of pages (e.g. pages removed from the dump) from an existing database.
+
+    :param database: path as string
+    :param page_ids: iterable of page ids (int)
     :return:
     """
 
-    # Insertion of data in WikitableInformation
-    table_info_form = 'INSERT INTO WikitableInformation VALUES (?, ?, ?, ?, ?)'
+    schema = get_schema(database)
+    sql_connection = sqlite3.connect(database)
+    delete_page_rows(sql_connection.cursor(), schema, list(page_ids))
+    sql_connection.commit()
+    sql_connection.close()
+
+
+def apply_pragmas(sql_connection, pragmas):
+    """
+    Apply pragmas to sqlite3 connection.
+
+    :param sql_connection: sqlite3 connection object
+    :param pragmas: list of strings
+    :return:
+    """
+
+    for i in pragmas:
+        sql_connection.execute(i)
+
+
+def drop_indexes(database, schema='default'):
+    """
+    Drop the indexes so that they are not maintained while loading (fast load mode).
+
+    :param database: path as string
+    :param schema: 'default' or 'compact'
+    :return:
+    """
+
+    sql_connection = sqlite3.connect(database)
+    for i in index_forms[schema]:
+        sql_connection.execute('DROP INDEX IF EXISTS ' + i)
+    sql_connection.commit()
+    sql_connection.close()
+
+
+def create_indexes(database, schema='default'):
+    """
+    Build the indexes in one pass once loading is done, then restore safe settings.
+
+    :param database: path as string
+    :param schema: 'default' or 'compact'
+    :return:
+    """
+
+    sql_connection = sqlite3.connect(database)
+    apply_pragmas(sql_connection, ['PRAGMA cache_size=-1048576', 'PRAGMA temp_store=MEMORY'])
+    for i in index_forms[schema].values():
+        sql_connection.execute(i)
+    sql_connection.commit()
+    apply_pragmas(sql_connection, safe_pragmas)
+    sql_connection.close()
+
+
+def own_attribute(fullattribute, rowattribute):
+    """
+    Get the attribute of a cell without the attribute of its row.
+
+    :param fullattribute: string
+    :param rowattribute: string
+    :return: string
+    """
+
+    if rowattribute == '':
+        return fullattribute
+    if fullattribute == rowattribute:
+        return ''
+    if fullattribute.startswith(rowattribute + ' '):
+        return fullattribute[len(rowattribute) + 1:]
+    return fullattribute
+
+
+def wikitable_data_to_rows(wikitabledata):
+    """
+    Build the WikitableInformation row and the WikitableData rows of one wikitable.
+
+    :param wikitabledata: wikitable data as dict
+    :return: rows (list of tuples) by table name, as dict
+    """
+
     table_name = wikitabledata['pagename'] + '_' + str(wikitabledata['tablecount'])
-    sql_cursor.execute(table_info_form, (wikitabledata['pagename'],
-                                         table_name,
-                                         wikitabledata['tableattribute'],
-                                         wikitabledata['caption']['name'],
-                                         wikitabledata['caption']['attribute']))
+    table_info = (wikitabledata['pagename'],
+                  table_name,
+                  wikitabledata['tableattribute'],
+                  wikitabledata['caption']['name'],
+                  wikitabledata['caption']['attribute'],
+                  wikitabledata.get('pageid'))
+
+    table_data = []
+    for i, row in enumerate(wikitabledata['rows']):
+        for j, el in enumerate(row):
+            span = extract_col_and_row_span(el['fullattribute'])
+            table_data.append((table_name, i, j, el['celldata'], el['fullattribute'],
+                               int(el['isheader']), span['rowspan'], span['colspan']))
+
+    return {'WikitableInformation': [table_info], 'WikitableData': table_data}
 
-    # Insertion of data in WikitableData
-    data_form = 'INSERT INTO WikitableData VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
 
+def wikitable_data_to_compact_rows(wikitabledata, table_id):
+    """
+    Build the WikitableInformation row, the WikitableRows rows and the WikitableData rows
+    of one wikitable for the compact schema.
+
+    :param wikitabledata: wikitable data as dict
+    :param table_id: int
+    :return: rows (list of tuples) by table name, as dict
+    """
+
+    table_info = (table_id,
+                  wikitabledata['pagename'],
+                  wikitabledata['tablecount'],
+                  wikitabledata['tableattribute'],
+                  wikitabledata['caption']['name'],
+                  wikitabledata['caption']['attribute'],
+                  wikitabledata.get('pageid'))
+
+    table_rows = []
+    table_data = []
     for i, row in enumerate(wikitabledata['rows']):
+        if len(row) != 0:
+            table_rows.append((table_id, i, row[0]['rowattribute']))
         for j, el in enumerate(row):
-            row_span = extract_col_and_row_span(el['fullattribute'])['rowspan']
-            col_span = extract_col_and_row_span(el['fullattribute'])['colspan']
-            sql_cursor.execute(data_form, (table_name, i, j, el['celldata'], el['fullattribute'],
-                                           int(el['isheader']), row_span, col_span))
+            span = extract_col_and_row_span(el['fullattribute'])
+            table_data.append((table_id, i, j, el['celldata'], own_attribute(el['fullattribute'], el['rowattribute']),
+                               int(el['isheader']), span['rowspan'], span['colspan']))
+
+    return {'WikitableInformation': [table_info], 'WikitableRows': table_rows, 'WikitableData': table_data}
+
+
+def new_row_buffers(schema='default'):
+    """
+    Get empty row buffers for the tables of schema.
+
+    :param schema: 'default' or 'compact'
+    :return: empty list by table name, as dict
+    """
+
+    return {table: [] for table in insert_forms[schema]}
 
 
-def process_many_wikitables_into_sql_database(wikitabledata_list, database):
+def append_wikitable_rows(rows, wikitabledata, schema='default', table_id=None):
+    """
+    Append the rows of one wikitable to row buffers.
+
+    :param rows: row buffers (list of tuples) by table name, as dict
+    :param wikitabledata: wikitable data as dict
+    :param schema: 'default' or 'compact'
+    :param table_id: int (compact schema only)
+    :return:
+    """
+
+    if schema == 'compact':
+        table_rows = wikitable_data_to_compact_rows(wikitabledata, table_id)
+    else:
+        table_rows = wikitable_data_to_rows(wikitabledata)
+    for table in rows:
+        rows[table].extend(table_rows[table])
+
+
+def insert_rows(rows, sql_cursor, schema='default', batch_size=10000):
+    """
+    Bulk insertion of rows via given cursor, by chunks of at most batch_size rows.
+
+    :param rows: rows (list of tuples) by table name, as dict
+    :param sql_cursor: sqlite3 cursor object
+    :param schema: 'default' or 'compact'
+    :param batch_size: int
+    :return:
+    """
+
+    for table, form in insert_forms[schema].items():
+        table_rows = rows[table]
+        for k in range(0, len(table_rows), batch_size):
+            sql_cursor.executemany(form, table_rows[k:k + batch_size])
+
+
+def next_table_id(sql_cursor):
+    """
+    Get the first unused table id of a compact database.
+
+    :param sql_cursor: sqlite3 cursor object
+    :return: int
+    """
+
+    return sql_cursor.execute('SELECT COALESCE(MAX(table_id), 0) + 1 FROM WikitableInformation').fetchone()[0]
+
+
+def wikitable_data_to_sql(wikitabledata, sql_cursor):
+    """
+    Insertion of wikitable information and cell data into sql database via given cursor.
+
+    :param wikitabledata: wikitable data as dict
+    :param sql_cursor: sqlite3 cursor object
+    :return:
+    """
+
+    insert_rows(wikitable_data_to_rows(wikitabledata), sql_cursor)
+
+
+def process_many_wikitables_into_sql_database(wikitabledata_list, database, batch_size=10000):
     """
     Process list of wikitables into sqlite3 database.
 
     :param wikitabledata_list: list of wikitabledata (each wikitabledata is a dict)
     :param database: path as string
+    :param batch_size: number of rows per executemany call, as int
     :return:
     """
 
+    writer_state = open_writer(database, batch_size)
+    write_wikitables(writer_state, wikitabledata_list)
+    commit(writer_state)
+    close_writer(writer_state)
+
+
+# Output backend interface (see also toarrow): open_writer, write_wikitables, commit, close_writer
+def open_writer(database, batch_size=10000, fast_load=False, page_filter_key=None, refresh=False):
+    """
+    Open the single writer of the sqlite3 database (with bulk-load pragmas if fast_load).
+
+    :param database: path as string
+    :param batch_size: number of rows per executemany call, as int
+    :param fast_load: bool
+    :param page_filter_key: page filter the streams are recorded with, as string (None to not record the streams)
+    :param refresh: True if the database holds the pages of a previous dump: the rows of the pages that had the
+                    title of a written page are deleted, as bool
+    :return: writer state as dict
+    """
+
+    schema = get_schema(database)
+    page_ids = has_page_ids(database)
     sql_connection = sqlite3.connect(database)
+    if fast_load:
+        apply_pragmas(sql_connection, fast_load_pragmas)
     sql_cursor = sql_connection.cursor()
+    sql_cursor.execute(progress_form)
+    sql_cursor.execute(page_revisions_form)
+    # databases created before the page ids were recorded
+    if not page_ids:
+        sql_cursor.execute('ALTER TABLE WikitableInformation ADD COLUMN page_id integer')
+    sql_connection.commit()
+
+    return {'connection': sql_connection, 'cursor': sql_cursor, 'schema': schema, 'batch_size': batch_size,
+            'rows': new_row_buffers(schema), 'table_id': next_table_id(sql_cursor) if schema == 'compact' else None,
+            'page_filter_key': page_filter_key, 'refresh': refresh, 'streams': []}
+
+
+def flush(writer_state):
+    """
+    Insert the buffered rows of the writer.
+
+    :param writer_state: writer state as dict
+    :return:
+    """
+
+    insert_rows(writer_state['rows'], writer_state['cursor'], writer_state['schema'], writer_state['batch_size'])
+    writer_state['rows'] = new_row_buffers(writer_state['schema'])
+
+
+def write_wikitables(writer_state, wikitabledata_list, stream=None, page_changes=None):
+    """
+    Buffer the rows of a list of wikitables, inserting them by executemany chunks of batch_size rows.
+
+    :param writer_state: writer state as dict
+    :param wikitabledata_list: list of wikitabledata (each wikitabledata is a dict)
+    :param stream: (dump_file, byte_offset) of the stream holding the wikitables, recorded as ingested
+                   with the next commit (None to not record it)
+    :param page_changes: pages of the stream whose wikitables change (see wikitableprocessing.new_page_changes):
+                         the rows of the changed pages are deleted and the revisions of the pages are recorded
+    :return:
+    """
+
+    if page_changes is not None:
+        delete_page_rows(writer_state['cursor'], writer_state['schema'], page_changes['changed'])
+        if writer_state['refresh']:
+            for i in delete_title_forms[writer_state['schema']]:
+                writer_state['cursor'].executemany(i, ((k[1], k[0]) for k in page_changes['revisions']))
+        writer_state['cursor'].executemany('INSERT OR REPLACE INTO PageRevisions VALUES (?, ?, ?)',
+                                           page_changes['revisions'])
+
+    if stream is not None and writer_state['page_filter_key'] is not None:
+        writer_state['streams'].append((stream[0], stream[1], writer_state['page_filter_key']))
 
     for i in wikitabledata_list:
-        wikitable_data_to_sql(i, sql_cursor)
+        append_wikitable_rows(writer_state['rows'], i, writer_state['schema'], writer_state['table_id'])
+        if writer_state['schema'] == 'compact':
+            writer_state['table_id'] += 1
+    if len(writer_state['rows']['WikitableData']) >= writer_state['batch_size']:
+        flush(writer_state)
 
-    sql_connection.commit()
-    sql_connection.close()
+
+def commit(writer_state):
+    """
+    Insert the buffered rows, record their streams as ingested and commit the transaction.
+
+    :param writer_state: writer state as dict
+    :return:
+    """
+
+    flush(writer_state)
+    writer_state['cursor'].executemany('INSERT OR IGNORE INTO IngestedStreams VALUES (?, ?, ?)',
+                                       writer_state['streams'])
+    writer_state['connection'].commit()
+    writer_state['streams'] = []
+
+
+def close_writer(writer_state):
+    """
+    Close the writer (uncommitted rows are discarded).
+
+    :param writer_state: writer state as dict
+    :return:
+    """
+
+    writer_state['connection'].close()
@@ -1,22 +1,47 @@
+import re
+from bisect import bisect_left, bisect_right
 
-import copy
 
+# True when this module was compiled with Cython (see setup.py), False for the pure Python module
+compiled = not __file__.endswith('.py')
 
-def check_in(position, info_pos_line_pairs):
+# Parser engines: 'char' feeds every character to table_proc, 'token' only feeds it the characters
+# that can change the table state and appends plain text runs in one step
+parser_engines = ('token', 'char')
+
+# Characters that can separate cells or start attributes in cell mode (outside of links and templates)
+cell_separator_regexp = re.compile(r'[|!]')
+# Runs of at least 2 identical brackets (a run continues on the next lines when nothing separates them)
+brackets_regexp = re.compile(r'\{(?:\n*\{)+|\}(?:\n*\})+|\[(?:\n*\[)+|\](?:\n*\])+')
+bracket_types = {'{': 'openingcurly', '}': 'closingcurly', '[': 'openingsquare', ']': 'closingsquare'}
+
+
+def index_pairs_by_start(info_pos_line_pairs):
     """
-    Check if position corresponds to the starting position of a pair in info_pos_line_pairs
-    (return pair if found, empty list otherwise)
-    :param position: list
+    Index pairs by their starting position (the first pair is kept if several pairs start at the same position)
+
     :param info_pos_line_pairs: list of lists
-    :return: list
+    :return: dict of pairs keyed by (in_line_position, line_number)
     """
 
     # pos_pair form: [info, [in_line_position_1, line_number_1], [in_line_position_2, line_number_2]]
+    pairs_by_start = {}
     for i in info_pos_line_pairs:
-        if position[0] == i[1][0] and position[1] == i[1][1]:
-            return i
+        pairs_by_start.setdefault((i[1][0], i[1][1]), i)
+
+    return pairs_by_start
+
 
-    return []
+def check_in(position, pairs_by_start):
+    """
+    Check if position corresponds to the starting position of a pair in pairs_by_start
+    (return pair if found, empty list otherwise)
+    :param position: tuple (in_line_position, line_number)
+    :param pairs_by_start: dict of pairs keyed by starting position (see index_pairs_by_start)
+    :return: list
+    """
+
+    return pairs_by_start.get(position, [])
 
 
 def tag_type_check(tag_buffer, tag_list):
@@ -38,41 +63,55 @@ def tag_type_check(tag_buffer, tag_list):
     return temp
 
 
-def curly_braces_matching(opening_stack_element, closing_stack_element, matches=None):
+def match_brackets(opening_stack_element, closing_stack_element, closing_start, matches, curly):
     """
-    Greedily match curly braces by groups of 2 or 3 (priority to groups of 3 when they can be matched)
+    Match the end of an opening run of brackets with a closing run of brackets starting at closing_start
+    (curly braces are greedily matched by groups of 2 or 3 with priority to groups of 3 when they can be matched,
+    square brackets by groups of 2)
 
     :param opening_stack_element: list of lists
     :param closing_stack_element: list of lists
+    :param closing_start: index of the first unmatched element of closing_stack_element
     :param matches: list of lists
-    :return: list of lists
+    :param curly: True for curly braces, False for square brackets
+    :return: number of unmatched elements of opening_stack_element, index of the first unmatched element of
+    closing_stack_element
     """
 
-    if matches is None:
-        matches = []
+    opening_end = len(opening_stack_element)
+    closing_length = len(closing_stack_element)
 
-    if len(closing_stack_element) < 2 or len(opening_stack_element) < 2:
-        return [opening_stack_element, closing_stack_element, matches]
-    elif len(closing_stack_element) == 2 or len(opening_stack_element) == 2:
-        start = opening_stack_element[-2][1:3]
-        end = closing_stack_element[1][1:3]
+    while opening_end >= 2 and closing_length - closing_start >= 2:
+        if not curly:
+            group, info = 2, 'link'
+        elif opening_end == 2 or closing_length - closing_start == 2:
+            group, info = 2, 'template'
+        else:
+            group, info = 3, 'tplarg'
+        matches.append([info, opening_stack_element[opening_end - group][1:3],
+                        closing_stack_element[closing_start + group - 1][1:3]])
+        opening_end -= group
+        closing_start += group
 
-        closing_stack_element = closing_stack_element[2:]
-        opening_stack_element = opening_stack_element[:-2]
+    return opening_end, closing_start
 
-        matches.append(['template', start, end])
 
-        return curly_braces_matching(opening_stack_element, closing_stack_element, matches)
-    else:
-        start = opening_stack_element[-3][1:3]
-        end = closing_stack_element[2][1:3]
+def curly_braces_matching(opening_stack_element, closing_stack_element, matches=None):
+    """
+    Greedily match curly braces by groups of 2 or 3 (priority to groups of 3 when they can be matched)
+
+    :param opening_stack_element: list of lists
+    :param closing_stack_element: list of lists
+    :param matches: list of lists
+    :return: list of lists
+    """
 
-        closing_stack_element = closing_stack_element[3:]
-        opening_stack_element = opening_stack_element[:-3]
+    if matches is None:
+        matches = []
 
-        matches.append(['tplarg', start, end])
+    opening_end, closing_start = match_brackets(opening_stack_element, closing_stack_element, 0, matches, True)
 
-        return curly_braces_matching(opening_stack_element, closing_stack_element, matches)
+    return [opening_stack_element[:opening_end], closing_stack_element[closing_start:], matches]
 
 
 def square_brackets_matching(opening_stack_element, closing_stack_element, matches=None):
@@ -88,18 +127,9 @@ def square_brackets_matching(opening_stack_element, closing_stack_element, match
     if matches is None:
         matches = []
 
-    if len(closing_stack_element) < 2 or len(opening_stack_element) < 2:
-        return [opening_stack_element, closing_stack_element, matches]
-    else:
-        start = opening_stack_element[-2][1:3]
-        end = closing_stack_element[1][1:3]
-
-        closing_stack_element = closing_stack_element[2:]
-        opening_stack_element = opening_stack_element[:-2]
-
-        matches.append(['link', start, end])
+    opening_end, closing_start = match_brackets(opening_stack_element, closing_stack_element, 0, matches, False)
 
-        return square_brackets_matching(opening_stack_element, closing_stack_element, matches)
+    return [opening_stack_element[:opening_end], closing_stack_element[closing_start:], matches]
 
 
 def consume_stacks(last_raw_stack, open_stack):
@@ -114,23 +144,21 @@ def consume_stacks(last_raw_stack, open_stack):
     pairs = []
 
     if last_raw_stack[0][0] == 'closingsquare':
-        while len(open_stack) > 0 and open_stack[-1][0][0] == 'openingsquare':
-            [opening_stack_element, last_raw_stack, pairs] = square_brackets_matching(open_stack[-1],
-                                                                                      last_raw_stack, pairs)
-            open_stack.pop()
-            if len(opening_stack_element) >= 2:
-                open_stack.append(opening_stack_element)
-            if len(last_raw_stack) < 2:
-                break
+        opening_type = 'openingsquare'
     else:
-        while len(open_stack) > 0 and open_stack[-1][0][0] == 'openingcurly':
-            [opening_stack_element, last_raw_stack, pairs] = curly_braces_matching(open_stack[-1],
-                                                                                   last_raw_stack, pairs)
-            open_stack.pop()
-            if len(opening_stack_element) >= 2:
-                open_stack.append(opening_stack_element)
-            if len(last_raw_stack) < 2:
-                break
+        opening_type = 'openingcurly'
+    curly = opening_type == 'openingcurly'
+
+    closing_start = 0
+    while len(open_stack) > 0 and open_stack[-1][0][0] == opening_type:
+        opening_stack_element = open_stack.pop()
+        opening_end, closing_start = match_brackets(opening_stack_element, last_raw_stack, closing_start, pairs,
+                                                    curly)
+        if opening_end >= 2:
+            del opening_stack_element[opening_end:]
+            open_stack.append(opening_stack_element)
+        if len(last_raw_stack) - closing_start < 2:
+            break
     last_raw_stack.clear()
 
     return pairs
@@ -153,7 +181,7 @@ def brackets_proc(i, element, line_number, last_raw_stack, open_stack, last, pai
     if element != last:
         if len(last_raw_stack) >= 2:
             if last == '[' or last == '{':
-                open_stack.append(copy.deepcopy(last_raw_stack))
+                open_stack.append(list(last_raw_stack))
             else:
                 pairs_list.extend(consume_stacks(last_raw_stack, open_stack))
         last_raw_stack.clear()
@@ -174,7 +202,7 @@ def first_pass(text):
     Find links, comments, escaped (or non wiki-formatted text), templates and template arguments
 
     :param text:
-    :return: list containing 2 lists
+    :return: list containing 2 dicts keyed by starting position (in_line_position, line_number)
                             (first one gives the locations of links, templates and template arguments,
                             second one gives the locations of comments, escaped text and non wiki-formatted text)
     """
@@ -276,7 +304,7 @@ def first_pass(text):
     element = ''
     brackets_proc(i, element, line_number, last_raw_stack, last_open_stack, last, template_other_list)
 
-    return [template_other_list, escape_comment_pos_list]
+    return [index_pairs_by_start(template_other_list), index_pairs_by_start(escape_comment_pos_list)]
 
 
 def table_proc(feed, feed_index, line_number, buffers, table_state, wikitabledata):
@@ -293,9 +321,9 @@ def table_proc(feed, feed_index, line_number, buffers, table_state, wikitabledat
     """
 
     if not buffers['templateindex']:
-        buffers['templateindex'] = check_in([feed_index, line_number], buffers['templatesotherpospairs'])
+        buffers['templateindex'] = check_in((feed_index, line_number), buffers['templatesotherpospairs'])
     if not buffers['escapecommentindex']:
-        buffers['escapecommentindex'] = check_in([feed_index, line_number], buffers['escapecommentpospairs'])
+        buffers['escapecommentindex'] = check_in((feed_index, line_number), buffers['escapecommentpospairs'])
 
     if table_state['cellmode']:
         if buffers['templateindex'] or buffers['escapecommentindex']:
@@ -307,10 +335,10 @@ def table_proc(feed, feed_index, line_number, buffers, table_state, wikitabledat
                 table_state['pipemode'] = False
                 table_state['attributerecorded'] = True
                 if buffers['tempdata']['rowattribute'] != '':
-                    buffers['tempdata']['fullattribute'] = copy.deepcopy(
-                        buffers['tempdata']['rowattribute']) + ' ' + copy.deepcopy(buffers['tempunit'])
+                    buffers['tempdata']['fullattribute'] = \
+                        buffers['tempdata']['rowattribute'] + ' ' + buffers['tempunit']
                 else:
-                    buffers['tempdata']['fullattribute'] = copy.deepcopy(buffers['tempunit'])
+                    buffers['tempdata']['fullattribute'] = buffers['tempunit']
                 buffers['tempunit'] = feed
             elif table_state['newlinemode']:
                 buffers['tempunit'] += '\n' + feed
@@ -335,19 +363,19 @@ def table_proc(feed, feed_index, line_number, buffers, table_state, wikitabledat
                     elif table_state['pipemode'] and not table_state['attributerecorded']:
                         table_state['pipemode'] = False
                         if buffers['tempdata']['rowattribute'] != '':
-                            buffers['tempdata']['fullattribute'] = copy.deepcopy(
-                                buffers['tempdata']['rowattribute']) + ' ' + copy.deepcopy(buffers['tempunit'])
+                            buffers['tempdata']['fullattribute'] = \
+                                buffers['tempdata']['rowattribute'] + ' ' + buffers['tempunit']
                         else:
-                            buffers['tempdata']['fullattribute'] = copy.deepcopy(buffers['tempunit'])
+                            buffers['tempdata']['fullattribute'] = buffers['tempunit']
                         buffers['tempunit'] = ''
                     # *** STORAGE *** store cell and reset
-                    buffers['tempdata']['celldata'] = copy.deepcopy(buffers['tempunit'])
+                    buffers['tempdata']['celldata'] = buffers['tempunit']
                     if table_state['captionmode']:
-                        wikitabledata['caption']['name'] = copy.deepcopy(buffers['tempdata']['celldata'])
-                        wikitabledata['caption']['attribute'] = copy.deepcopy(buffers['tempdata']['fullattribute'])
+                        wikitabledata['caption']['name'] = buffers['tempdata']['celldata']
+                        wikitabledata['caption']['attribute'] = buffers['tempdata']['fullattribute']
                         table_state['captionmode'] = False
                     else:
-                        buffers['temprow'].append(copy.deepcopy(buffers['tempdata']))
+                        buffers['temprow'].append(dict(buffers['tempdata']))
                     buffers['tempdata']['fullattribute'] = ''
                     buffers['tempdata']['isheader'] = False
                     buffers['tempdata']['celldata'] = ''
@@ -365,19 +393,19 @@ def table_proc(feed, feed_index, line_number, buffers, table_state, wikitabledat
                     elif table_state['pipemode'] and not table_state['attributerecorded']:
                         table_state['pipemode'] = False
                         if buffers['tempdata']['rowattribute'] != '':
-                            buffers['tempdata']['fullattribute'] = copy.deepcopy(
-                                buffers['tempdata']['rowattribute']) + ' ' + copy.deepcopy(buffers['tempunit'])
+                            buffers['tempdata']['fullattribute'] = \
+                                buffers['tempdata']['rowattribute'] + ' ' + buffers['tempunit']
                         else:
-                            buffers['tempdata']['fullattribute'] = copy.deepcopy(buffers['tempunit'])
+                            buffers['tempdata']['fullattribute'] = buffers['tempunit']
                         buffers['tempunit'] = ''
                     # *** STORAGE *** store cell and reset
-                    buffers['tempdata']['celldata'] = copy.deepcopy(buffers['tempunit'])
+                    buffers['tempdata']['celldata'] = buffers['tempunit']
                     if table_state['captionmode']:
-                        wikitabledata['caption']['name'] = copy.deepcopy(buffers['tempdata']['celldata'])
-                        wikitabledata['caption']['attribute'] = copy.deepcopy(buffers['tempdata']['fullattribute'])
+                        wikitabledata['caption']['name'] = buffers['tempdata']['celldata']
+                        wikitabledata['caption']['attribute'] = buffers['tempdata']['fullattribute']
                         table_state['captionmode'] = False
                     else:
-                        buffers['temprow'].append(copy.deepcopy(buffers['tempdata']))
+                        buffers['temprow'].append(dict(buffers['tempdata']))
                     buffers['tempdata']['fullattribute'] = ''
                     buffers['tempdata']['isheader'] = False
                     buffers['tempdata']['celldata'] = ''
@@ -399,10 +427,10 @@ def table_proc(feed, feed_index, line_number, buffers, table_state, wikitabledat
                         table_state['pipemode'] = False
                     elif table_state['pipemode'] and not table_state['attributerecorded']:
                         if buffers['tempdata']['rowattribute'] != '':
-                            buffers['tempdata']['fullattribute'] = copy.deepcopy(
-                                buffers['tempdata']['rowattribute']) + ' ' + copy.deepcopy(buffers['tempunit'])
+                            buffers['tempdata']['fullattribute'] = \
+                                buffers['tempdata']['rowattribute'] + ' ' + buffers['tempunit']
                         else:
-                            buffers['tempdata']['fullattribute'] = copy.deepcopy(buffers['tempunit'])
+                            buffers['tempdata']['fullattribute'] = buffers['tempunit']
                         buffers['tempunit'] = '\n' + feed
                         table_state['attributerecorded'] = True
                         table_state['pipemode'] = False
@@ -420,8 +448,8 @@ def table_proc(feed, feed_index, line_number, buffers, table_state, wikitabledat
                     if table_state['captionmode']:
                         buffers['tempdata']['celldata'] += '\n'
                     else:
-                        buffers['tempdata']['celldata'] = copy.deepcopy(buffers['tempunit'])
-                        buffers['temprow'].append(copy.deepcopy(buffers['tempdata']))
+                        buffers['tempdata']['celldata'] = buffers['tempunit']
+                        buffers['temprow'].append(dict(buffers['tempdata']))
                         buffers['tempdata']['fullattribute'] = ''
                         buffers['tempdata']['isheader'] = False
                         buffers['tempdata']['celldata'] = ''
@@ -431,8 +459,8 @@ def table_proc(feed, feed_index, line_number, buffers, table_state, wikitabledat
             elif feed == '!':
                 if table_state['headerrowmode'] and table_state['interogmode']:
                     # *** STORAGE ***
-                    buffers['tempdata']['celldata'] = copy.deepcopy(buffers['tempunit'])
-                    buffers['temprow'].append(copy.deepcopy(buffers['tempdata']))
+                    buffers['tempdata']['celldata'] = buffers['tempunit']
+                    buffers['temprow'].append(dict(buffers['tempdata']))
                     buffers['tempdata']['fullattribute'] = ''
                     buffers['tempdata']['celldata'] = ''
                     buffers['tempunit'] = ''
@@ -443,10 +471,10 @@ def table_proc(feed, feed_index, line_number, buffers, table_state, wikitabledat
                         table_state['pipemode'] = False
                     elif table_state['pipemode'] and not table_state['attributerecorded']:
                         if buffers['tempdata']['rowattribute'] != '':
-                            buffers['tempdata']['fullattribute'] = copy.deepcopy(
-                                buffers['tempdata']['rowattribute']) + ' ' + copy.deepcopy(buffers['tempunit'])
+                            buffers['tempdata']['fullattribute'] = \
+                                buffers['tempdata']['rowattribute'] + ' ' + buffers['tempunit']
                         else:
-                            buffers['tempdata']['fullattribute'] = copy.deepcopy(buffers['tempunit'])
+                            buffers['tempdata']['fullattribute'] = buffers['tempunit']
                         buffers['tempunit'] = ''
                         table_state['attributerecorded'] = True
                         table_state['pipemode'] = False
@@ -458,10 +486,10 @@ def table_proc(feed, feed_index, line_number, buffers, table_state, wikitabledat
                         table_state['pipemode'] = False
                     elif table_state['pipemode'] and not table_state['attributerecorded']:
                         if buffers['tempdata']['rowattribute'] != '':
-                            buffers['tempdata']['fullattribute'] = copy.deepcopy(
-                                buffers['tempdata']['rowattribute']) + ' ' + copy.deepcopy(buffers['tempunit'])
+                            buffers['tempdata']['fullattribute'] = \
+                                buffers['tempdata']['rowattribute'] + ' ' + buffers['tempunit']
                         else:
-                            buffers['tempdata']['fullattribute'] = copy.deepcopy(buffers['tempunit'])
+                            buffers['tempdata']['fullattribute'] = buffers['tempunit']
                         buffers['tempunit'] = '!'
                         table_state['attributerecorded'] = True
                         table_state['pipemode'] = False
@@ -478,10 +506,10 @@ def table_proc(feed, feed_index, line_number, buffers, table_state, wikitabledat
                     table_state['pipemode'] = False
                 elif table_state['pipemode'] and not table_state['attributerecorded']:
                     if buffers['tempdata']['rowattribute'] != '':
-                        buffers['tempdata']['fullattribute'] = copy.deepcopy(
-                            buffers['tempdata']['rowattribute']) + ' ' + copy.deepcopy(buffers['tempunit'])
+                        buffers['tempdata']['fullattribute'] = \
+                            buffers['tempdata']['rowattribute'] + ' ' + buffers['tempunit']
                     else:
-                        buffers['tempdata']['fullattribute'] = copy.deepcopy(buffers['tempunit'])
+                        buffers['tempdata']['fullattribute'] = buffers['tempunit']
                     buffers['tempunit'] = feed
                     table_state['attributerecorded'] = True
                     table_state['pipemode'] = False
@@ -491,10 +519,10 @@ def table_proc(feed, feed_index, line_number, buffers, table_state, wikitabledat
         if table_state['newlinemode']:
             # if feed is '|' dump tempdata and stay in startmode
             if feed == '|':
-                buffers['temprow'].append(copy.deepcopy(buffers['tempdata']))
+                buffers['temprow'].append(dict(buffers['tempdata']))
             # if feed is '!' dump tempdata, leave startmode and enter headerrowmode, header attribute and cellmode
             elif feed == '!':
-                buffers['temprow'].append(copy.deepcopy(buffers['tempdata']))
+                buffers['temprow'].append(dict(buffers['tempdata']))
                 table_state['startmode'] = False
                 table_state['headerrowmode'] = True
                 table_state['cellmode'] = True
@@ -510,8 +538,8 @@ def table_proc(feed, feed_index, line_number, buffers, table_state, wikitabledat
             table_state['startmode'] = False
         elif feed == '-':
             if len(buffers['temprow']) != 0:
-                wikitabledata['rows'].append(copy.deepcopy(buffers['temprow']))
-                buffers['temprow'].clear()
+                wikitabledata['rows'].append(buffers['temprow'])
+                buffers['temprow'] = []
             table_state['startmode'] = False
             table_state['newrowmode'] = True
         else:
@@ -522,7 +550,7 @@ def table_proc(feed, feed_index, line_number, buffers, table_state, wikitabledat
     else:
         if table_state['newlinemode']:
             if table_state['newrowmode']:
-                buffers['tempdata']['rowattribute'] = copy.deepcopy(buffers['tempunit'])
+                buffers['tempdata']['rowattribute'] = buffers['tempunit']
                 buffers['tempunit'] = ''
                 table_state['newrowmode'] = False
 
@@ -545,13 +573,112 @@ def table_proc(feed, feed_index, line_number, buffers, table_state, wikitabledat
     table_state['newlinemode'] = False
 
 
-def wikitable_parser(raw_wikitable, page_name, table_count):
+def first_pass_tokens(text):
+    """
+    Token-based equivalent of first_pass for text without tags (no comments nor escaped text):
+    links, templates and template arguments are matched from the runs of identical brackets.
+
+    :param text: list of strings
+    :return: list containing 2 dicts keyed by starting position (in_line_position, line_number) (see first_pass)
+    """
+
+    template_other_list = []
+    last_open_stack = []
+
+    joined_text = '\n'.join(text)
+    line_starts = [0]
+    for line in text:
+        line_starts.append(line_starts[-1] + len(line) + 1)
+
+    for bracket_run in brackets_regexp.finditer(joined_text):
+        line_number = bisect_right(line_starts, bracket_run.start()) - 1
+        i = bracket_run.start() - line_starts[line_number]
+        bracket_type = bracket_types[bracket_run.group()[0]]
+        last_raw_stack = []
+        for element in bracket_run.group():
+            if element == '\n':
+                line_number += 1
+                i = 0
+            else:
+                last_raw_stack.append([bracket_type, i, line_number])
+                i += 1
+
+        if bracket_type == 'openingcurly' or bracket_type == 'openingsquare':
+            last_open_stack.append(last_raw_stack)
+        else:
+            template_other_list.extend(consume_stacks(last_raw_stack, last_open_stack))
+
+    return [index_pairs_by_start(template_other_list), {}]
+
+
+def table_tokens_proc(tablecontent, buffers, table_state, wikitabledata):
+    """
+    Token-based equivalent of feeding every character of tablecontent to table_proc.
+
+    Within a line, the characters that can change the table state (first character of the line,
+    characters read in start mode or right after '|' or '!', cell separators '|' and '!' in cell mode,
+    starting and ending characters of links, templates and template arguments) are fed to table_proc.
+    The plain text runs in between only extend the current unit, they are appended in one step.
+
+    :param tablecontent: list of strings
+    :param buffers:
+    :param table_state:
+    :param wikitabledata:
+    :return:
+    """
+
+    # starting positions of links, templates and template arguments by line
+    template_starts = {}
+    for in_line_position, line_number in sorted(buffers['templatesotherpospairs']):
+        template_starts.setdefault(line_number, []).append(in_line_position)
+
+    for linenumber, line in enumerate(tablecontent):
+        table_state['newlinemode'] = True
+        table_state['headerrowmode'] = False
+        starts = template_starts.get(linenumber, [])
+        line_length = len(line)
+        k = 0
+        while k < line_length:
+            if table_state['newlinemode'] or table_state['startmode'] or table_state['pipemode'] or \
+                    table_state['interogmode']:
+                table_proc(line[k], k, linenumber, buffers, table_state, wikitabledata)
+                k += 1
+                continue
+
+            # end of the plain text run
+            template = buffers['templateindex']
+            if template:
+                # inside a link or template: up to its last character
+                stop = template[2][0] if template[2][1] == linenumber else line_length
+            else:
+                # up to the next link or template start (or cell separator in cell mode)
+                next_start = bisect_left(starts, k)
+                stop = starts[next_start] if next_start < len(starts) else line_length
+                if table_state['cellmode']:
+                    separator = cell_separator_regexp.search(line, k, stop)
+                    if separator is not None:
+                        stop = separator.start()
+
+            if stop > k:
+                buffers['tempunit'] += line[k:stop]
+                if table_state['cellmode'] and template and (template[0] == 'link' or template[0] == 'template'):
+                    table_state['attributerecorded'] = True
+                    if buffers['tempdata']['fullattribute'] == '':
+                        buffers['tempdata']['fullattribute'] = buffers['tempdata']['rowattribute']
+                k = stop
+            if k < line_length:
+                table_proc(line[k], k, linenumber, buffers, table_state, wikitabledata)
+                k += 1
+
+
+def wikitable_parser(raw_wikitable, page_name, table_count, engine='token'):
     """
     Wikitable parser
 
     :param raw_wikitable: string
     :param page_name: string
     :param table_count: int
+    :param engine: 'token' or 'char' (see parser_engines)
     :return: dict
     """
 
@@ -567,8 +694,8 @@ def wikitable_parser(raw_wikitable, page_name, table_count):
     buffers['temprow'] = []
 
     # other buffers
-    buffers['templatesotherpospairs'] = []
-    buffers['escapecommentpospairs'] = []
+    buffers['templatesotherpospairs'] = {}
+    buffers['escapecommentpospairs'] = {}
     buffers['templateindex'] = []
     buffers['escapecommentindex'] = []
     buffers['last'] = ''
@@ -594,34 +721,40 @@ def wikitable_parser(raw_wikitable, page_name, table_count):
 
     wikitabledata['tableattribute'] = raw_wikitable.splitlines()[0][2:]
     tablecontent = raw_wikitable.splitlines()[1:-1]
-    [buffers['templatesotherpospairs'], buffers['escapecommentpospairs']] = first_pass(tablecontent)
-    for linenumber, line in enumerate(tablecontent):
-        tablestate['newlinemode'] = True
-        tablestate['headerrowmode'] = False
-        for i, feed in enumerate(line):
-            table_proc(feed, i, linenumber, buffers, tablestate, wikitabledata)
+    # comments and escaped text are only handled by the char engine
+    if engine == 'token' and not any('<' in line for line in tablecontent):
+        [buffers['templatesotherpospairs'], buffers['escapecommentpospairs']] = first_pass_tokens(tablecontent)
+    else:
+        [buffers['templatesotherpospairs'], buffers['escapecommentpospairs']] = first_pass(tablecontent)
+    if engine == 'token' and not buffers['escapecommentpospairs']:
+        table_tokens_proc(tablecontent, buffers, tablestate, wikitabledata)
+    else:
+        for linenumber, line in enumerate(tablecontent):
+            tablestate['newlinemode'] = True
+            tablestate['headerrowmode'] = False
+            for i, feed in enumerate(line):
+                table_proc(feed, i, linenumber, buffers, tablestate, wikitabledata)
+                if tablestate['problem']:
+                    buffers['problem']['line-number'] = linenumber
+                    buffers['problem']['index'] = i
+                    buffers['problem']['raw'] = tablecontent
+                    break
             if tablestate['problem']:
-                buffers['problem']['line-number'] = linenumber
-                buffers['problem']['index'] = i
-                buffers['problem']['raw'] = tablecontent
-                break
-        if tablestate['problem']:
-            return [{'pagename': page_name, 'tablecount': table_count, 'problem': buffers['problem']}]
+                return [{'pagename': page_name, 'tablecount': table_count, 'problem': buffers['problem']}]
 
     if tablestate['pipemode'] and tablestate['attributerecorded']:
         buffers['tempunit'] += '|'
     elif tablestate['pipemode'] and not tablestate['attributerecorded']:
         if buffers['tempdata']['rowattribute'] == '':
-            buffers['tempdata']['fullattribute'] = copy.deepcopy(buffers['tempunit'])
+            buffers['tempdata']['fullattribute'] = buffers['tempunit']
         else:
-            buffers['tempdata']['fullattribute'] = copy.deepcopy(
-                buffers['tempdata']['rowattribute']) + ' ' + copy.deepcopy(buffers['tempunit'])
+            buffers['tempdata']['fullattribute'] = buffers['tempdata']['rowattribute'] + ' ' + buffers['tempunit']
         buffers['tempunit'] = ''
 
     # store cell
-    buffers['tempdata']['celldata'] = copy.deepcopy(buffers['tempunit'])
-    buffers['temprow'].append(copy.deepcopy(buffers['tempdata']))
+    buffers['tempdata']['celldata'] = buffers['tempunit']
+    buffers['temprow'].append(dict(buffers['tempdata']))
     # add last row
-    wikitabledata['rows'].append(copy.deepcopy(buffers['temprow']))
+    wikitabledata['rows'].append(buffers['temprow'])
 
     return wikitabledata
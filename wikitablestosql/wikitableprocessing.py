@@ -1,7 +1,13 @@
 
+import re
+import json
+import itertools
 from importlib import util
+from xml.sax.saxutils import escape
 
 from . import wikitableparser
+from . import tablecache
+from . import stagemetrics
 
 
 defused_check = util.find_spec('defusedxml')
@@ -11,123 +17,306 @@ else:
     import xml.etree.ElementTree as Et
 
 
+# Candidate table delimiters: position of the '{' of every '{|' and of the '|' of every '|}'
+table_delimiter_regexp = re.compile(r'\{(?=\|)|\|(?=\})')
+
+
 # Get wikitables
 def get_wikitables_from_string(string):
     """
     Get raw wikitables from "unstructured" string
 
+    Delimiters are only taken into account after the first line starting with '{' or '|'.
+
     :param string:
     :return: list of raw wikitables
     """
 
-    last = ''
-    in_table = False
-    newline = False
-    waiting = False
-    temp_string = ''
     table_count = 0
     list_of_tables = []
     table_nest_level = 0
+    table_begin = 0
 
-    for i in string:
-        if in_table:
-            temp_string += i
-        if i == '\n':
-            newline = True
-        elif newline:
-            if i == '{' or i == '|':
-                waiting = True
-                newline = False
-            elif i != '\n':
-                newline = False
-        elif waiting:
-            if last == '{' and i == '|':
-                if table_nest_level == 0:
-                    in_table = True
-                    temp_string += '{|'
-                table_nest_level += 1
-            elif last == '|' and i == '}':
-                if in_table:
-                    table_nest_level += -1
-                    if table_nest_level == 0:
-                        in_table = False
-                        list_of_tables.append([table_count, temp_string])
-                        temp_string = ''
-                        table_count += 1
-        last = i
+    # first character of the first line starting with '{' or '|'
+    line_start = [k for k in (string.find('\n{'), string.find('\n|')) if k != -1]
+    if not line_start:
+        return list_of_tables
+
+    for delimiter in table_delimiter_regexp.finditer(string, min(line_start) + 1):
+        k = delimiter.start()
+        if string[k] == '{':
+            if table_nest_level == 0:
+                table_begin = k
+            table_nest_level += 1
+        elif table_nest_level > 0:
+            table_nest_level += -1
+            if table_nest_level == 0:
+                list_of_tables.append([table_count, string[table_begin:k + 2]])
+                table_count += 1
 
     return list_of_tables
 
 
-def extract_wikitables_from_file(file):
+def serialize_text(text):
+    """
+    Escape text as it is serialized by Et.tostring (markup characters and non-ASCII characters
+    are replaced by entities), which is the form raw wikitables have always been stored in.
+
+    :param text: string
+    :return: string
+    """
+
+    return escape(text).encode('ascii', 'xmlcharrefreplace').decode('ascii')
+
+
+class ChunkReader:
+    """Read-only file object over an iterable of bytes chunks (source for iterparse)"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = b''
+        self.position = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            data = self.chunk[self.position:] + b''.join(self.chunks)
+            self.chunk = b''
+            self.position = 0
+            return data
+        # at most size bytes, from the current chunk only (empty once all chunks are read)
+        while self.position >= len(self.chunk):
+            self.chunk = next(self.chunks, None)
+            self.position = 0
+            if self.chunk is None:
+                self.chunk = b''
+                return b''
+        data = self.chunk[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+
+def iter_pages(chunks, last_stream=False):
+    """
+    Incrementally parse decompressed xml chunks and yield the page elements one at a time
+    (each page is cleared once the caller is done with it)
+
+    :param chunks: iterable of xml chunks (bytes)
+    :param last_stream: True for the last stream of a multistream file, as bool
+    :return: generator of page elements
+    """
+
+    # For last decompressed stream (add mediawiki tag)
+    if last_stream:
+        prefix = b'<root><mediawiki>\n'
+    else:
+        prefix = b'<root>'
+
+    source = ChunkReader(itertools.chain([prefix], chunks, [b'</root>']))
+    for event, element in Et.iterparse(source, events=('end',)):
+        if element.tag == 'page':
+            yield element
+            element.clear()
+
+
+def new_page_filter(namespaces=None, skip_redirects=False, page_ids=None, revisions=None):
+    """
+    Create a page filter (pages are kept by default).
+
+    :param namespaces: namespace numbers of the pages to keep as iterable of int (None to keep all namespaces)
+    :param skip_redirects: True to skip redirect pages, as bool
+    :param page_ids: ids of the pages to keep as iterable of int (None to keep all pages)
+    :param revisions: revision ids of the pages already in the output by page id, as dict (pages whose revision
+                      is unchanged are skipped, None to keep all pages)
+    :return: page filter as dict
+    """
+
+    return {'namespaces': None if namespaces is None else frozenset(namespaces),
+            'skip_redirects': skip_redirects,
+            'page_ids': None if page_ids is None else frozenset(page_ids),
+            'revisions': revisions}
+
+
+def get_page_filter_key(page_filter):
+    """
+    Describe the namespaces and redirects kept by a page filter (the streams ingested with a page filter are
+    recorded with its key).
+
+    :param page_filter: page filter as dict (see new_page_filter)
+    :return: string
+    """
+
+    namespaces = None if page_filter['namespaces'] is None else sorted(page_filter['namespaces'])
+    return json.dumps({'namespaces': namespaces, 'skip_redirects': page_filter['skip_redirects']}, sort_keys=True)
+
+
+def new_skip_counts():
+    """
+    Create the counts of skipped pages by reason.
+
+    :return: dict
+    """
+
+    return {'not_selected': 0, 'unchanged': 0, 'namespace': 0, 'redirect': 0, 'no_table': 0}
+
+
+def add_skip_counts(total, skip_counts):
+    """
+    Add skip_counts to total.
+
+    :param total: counts of skipped pages by reason as dict
+    :param skip_counts: counts of skipped pages by reason as dict
+    :return:
+    """
+
+    for reason, count in skip_counts.items():
+        total[reason] += count
+
+
+def new_page_changes():
+    """
+    Create the record of the pages whose wikitables change in the output.
+
+    :return: dict with 'changed' (ids of the pages already in the output whose revision changed, as list) and
+             'revisions' (page id, page name and revision id of the new or changed pages with wikitables, as list)
+    """
+
+    return {'changed': [], 'revisions': []}
+
+
+def get_skip_reason(page, text, page_filter, page_changes=None):
+    """
+    Check page against page_filter before any search for wikitables.
+
+    :param page: page element
+    :param text: text of the page revision as string (None if empty)
+    :param page_filter: page filter as dict (see new_page_filter)
+    :param page_changes: pages whose wikitables change, updated in place, as dict (see new_page_changes)
+    :return: reason to skip the page as string ('not_selected', 'unchanged', 'namespace', 'redirect' or
+    'no_table'), None to keep it
     """
-    Extract wikitables from xml file
 
-    :param file: path as string
+    page_id = int(page.findtext('id'))
+    if page_filter['page_ids'] is not None and page_id not in page_filter['page_ids']:
+        return 'not_selected'
+    if page_filter['revisions'] is not None and page_id in page_filter['revisions']:
+        if page_filter['revisions'][page_id] == int(page.findtext('revision/id')):
+            return 'unchanged'
+        # the wikitables of the previous revision are replaced (or deleted if the page is skipped)
+        if page_changes is not None:
+            page_changes['changed'].append(page_id)
+    if page_filter['namespaces'] is not None and int(page.findtext('ns', '0')) not in page_filter['namespaces']:
+        return 'namespace'
+    if page_filter['skip_redirects'] and page.find('redirect') is not None:
+        return 'redirect'
+    # no table without '{|'
+    if not text or '{|' not in text:
+        return 'no_table'
+
+    return None
+
+
+def extract_wikitables_from_chunks(chunks, last_stream=False, page_filter=None, skip_counts=None,
+                                   page_changes=None, metrics=None):
+    """
+    Extract wikitables from decompressed xml chunks
+
+    :param chunks: iterable of xml chunks (bytes)
+    :param last_stream: True for the last stream of a multistream file, as bool
+    :param page_filter: page filter as dict (see new_page_filter), all pages with tables are kept if None
+    :param skip_counts: counts of skipped pages by reason, updated in place, as dict (see new_skip_counts)
+    :param page_changes: pages whose wikitables change, updated in place, as dict (see new_page_changes)
+    :param metrics: stage metrics ('xml_parse' and 'table_scan'), updated in place, as dict
+                    (see stagemetrics.new_metrics), None to not collect them
     :return: list of wikitabledata elements (list of dict)
     """
 
     wikitabledata_list = []
-    
-    with open(file, mode='r', encoding='UTF-8') as f:
-        data = f.read()
-    
-    data_rooted = '<root>' + data + '</root>'
-    parsed = Et.fromstring(data_rooted)
-    pages = parsed.findall('page')
-
-    # For last decompressed part
-    mediawiki = parsed.find('mediawiki')
-    if mediawiki is not None:
-        m_pages = mediawiki.findall('page')
-    else:
-        m_pages = []
-    if len(pages) == 0 and len(m_pages) != 0:
-        pages = m_pages
-    ###
-
-    for i in pages:
-        s = Et.tostring(i)
-        temp_page_table_data = get_wikitables_from_string(s.decode('UTF-8'))
+    if page_filter is None:
+        page_filter = new_page_filter()
+    if skip_counts is None:
+        skip_counts = new_skip_counts()
+
+    for i in stagemetrics.iter_timed(metrics, 'xml_parse', iter_pages(chunks, last_stream)):
+        stagemetrics.add_stage_counts(metrics, 'xml_parse', items=1)
+        text = i.findtext('revision/text')
+        skip_reason = get_skip_reason(i, text, page_filter, page_changes)
+        if skip_reason is not None:
+            skip_counts[skip_reason] += 1
+            continue
+        start = stagemetrics.start_stage(metrics)
+        temp_page_table_data = get_wikitables_from_string(text)
+        if page_changes is not None and temp_page_table_data:
+            page_changes['revisions'].append((int(i.findtext('id')), i.findtext('title'),
+                                              int(i.findtext('revision/id'))))
         for j in temp_page_table_data:
             wikitabledata = {
                 'PageName': (i.find('title')).text,
                 'PageId': (i.find('id')).text,
                 'TableId': j[0],
-                'WikitableData': j[1]}
+                'WikitableData': serialize_text(j[1])}
             wikitabledata_list.append(wikitabledata)
-    
+        stagemetrics.end_stage(metrics, 'table_scan', start, bytes_in=len(text), items=len(temp_page_table_data))
+
     return wikitabledata_list
 
 
-# For last decompressed part (add mediawiki tag then parse pages)
-def prepend_file(file, prepended_text='<mediawiki>\n'):
+def extract_wikitables_from_string(data, last_stream=False):
     """
-    Prepend file (with '<mediawiki>\n' by default)
+    Extract wikitables from decompressed xml data
 
-    :param file: path as string
-    :param prepended_text: string
-    :return:
+    :param data: xml as bytes
+    :param last_stream: True for the last stream of a multistream file, as bool
+    :return: list of wikitabledata elements (list of dict)
     """
 
-    with open(file, mode='r', encoding='UTF-8') as f:
-        original = f.read()
-    with open(file, mode='w', encoding='UTF-8') as g:
-        g.write(prepended_text + original)
+    return extract_wikitables_from_chunks([data], last_stream)
 
 
-def parse_wikitables_from_file(file):
+def parse_wikitables_from_chunks(chunks, last_stream=False, engine='token', page_filter=None, skip_counts=None,
+                                 page_changes=None, table_cache=None, metrics=None):
     """
-    Parse all raw wikitables from file
+    Parse all raw wikitables from decompressed xml chunks
 
-    :param file: path as string
+    :param chunks: iterable of xml chunks (bytes)
+    :param last_stream: True for the last stream of a multistream file, as bool
+    :param engine: parser engine (see wikitableparser.parser_engines)
+    :param page_filter: page filter as dict (see new_page_filter)
+    :param skip_counts: counts of skipped pages by reason, updated in place, as dict (see new_skip_counts)
+    :param page_changes: pages whose wikitables change, updated in place, as dict (see new_page_changes)
+    :param table_cache: table cache lookup state as dict (see tablecache.open_table_cache_reader), None to parse
+                        every wikitable
+    :param metrics: stage metrics ('xml_parse', 'table_scan' and 'table_parse'), updated in place, as dict
+                    (see stagemetrics.new_metrics), None to not collect them
     :return: list of parsed wikitables (each element is a dict)
     """
 
-    raw_wikitables = extract_wikitables_from_file(file)
+    raw_wikitables = extract_wikitables_from_chunks(chunks, last_stream, page_filter, skip_counts, page_changes,
+                                                    metrics)
     parsed = []
 
     for i in raw_wikitables:
-        parsed.append(wikitableparser.wikitable_parser(i['WikitableData'], i['PageName'], i['TableId']))
+        start = stagemetrics.start_stage(metrics)
+        if table_cache is None:
+            parsed.append(wikitableparser.wikitable_parser(i['WikitableData'], i['PageName'], i['TableId'], engine))
+        else:
+            parsed.append(tablecache.parse_wikitable(table_cache, i['WikitableData'], i['PageName'], i['TableId'],
+                                                     engine))
+        # the page id identifies the rows of the page (titles change when pages are moved)
+        if isinstance(parsed[-1], dict):
+            parsed[-1]['pageid'] = int(i['PageId'])
+        stagemetrics.end_stage(metrics, 'table_parse', start, bytes_in=len(i['WikitableData']), items=1)
 
     return parsed
+
+
+def parse_wikitables_from_string(data, last_stream=False, engine='token'):
+    """
+    Parse all raw wikitables from decompressed xml data
+
+    :param data: xml as bytes
+    :param last_stream: True for the last stream of a multistream file, as bool
+    :param engine: parser engine (see wikitableparser.parser_engines)
+    :return: list of parsed wikitables (each element is a dict)
+    """
+
+    return parse_wikitables_from_chunks([data], last_stream, engine)
@@ -1,15 +1,21 @@
 
 import os
 import sys
+import signal
 import argparse
 import multiprocessing
 import threading
-import functools
+import queue
 import time
+import shutil
 
 from . import wikitableprocessing
+from . import wikitableparser
 from . import multistreamfilehandling
 from . import tosql
+from . import toarrow
+from . import tablecache
+from . import stagemetrics
 
 
 # Progress bar code
@@ -24,7 +30,8 @@ def progress_animator(indicators, symbol_loop=('--', "\\", '|', '/'), suffix='',
         state = (state + 1) % len(symbol_loop)
         time.sleep(interval)
         prefix = task + '[' + str(indicators['done']) + '/' + str(indicators['total']) + '] '
-        message = prefix + symbol_loop[state] + suffix
+        backlog = ' (write queue: ' + str(indicators['queue']) + '/' + str(indicators['queue_size']) + ')'
+        message = prefix + symbol_loop[state] + backlog + suffix
         print(length * ' ', end='\r')
         print(message, end='\r')
     print('')
@@ -36,6 +43,43 @@ def progress_animator(indicators, symbol_loop=('--', "\\", '|', '/'), suffix='',
         print('DONE!')
 
 
+def get_metrics_snapshot(metrics_list, indicators):
+    """
+    Summarize the stage metrics of the run with its queue depths (streams waiting for a worker and parsed
+    streams waiting to be written).
+
+    :param metrics_list: list of stage metrics as dict (see stagemetrics.new_metrics)
+    :param indicators: progress indicators as dict
+    :return: dict (see stagemetrics.get_snapshot)
+    """
+
+    queued_streams = sum(k['stages']['index']['items'] for k in metrics_list)
+    queues = {'tasks': queued_streams - indicators['received'], 'write': indicators['queue']}
+    snapshot = stagemetrics.get_snapshot(metrics_list, time.perf_counter() - indicators['start_time'], queues)
+    snapshot['streams'] = indicators['received']
+    return snapshot
+
+
+def metrics_reporter(indicators, metrics_list, filename, interval):
+    """
+    Write a snapshot of the stage metrics to filename (JSON lines) every interval seconds until the end of the run.
+
+    :param indicators: progress indicators as dict
+    :param metrics_list: list of stage metrics as dict (see stagemetrics.new_metrics)
+    :param filename: path as string
+    :param interval: seconds as float
+    :return:
+    """
+
+    with open(filename, mode='w', encoding='UTF-8') as f:
+        next_report = time.perf_counter() + interval
+        while not indicators['end']:
+            time.sleep(0.1)
+            if time.perf_counter() >= next_report:
+                stagemetrics.write_snapshot(f, get_metrics_snapshot(metrics_list, indicators))
+                next_report += interval
+
+
 def associate_to_index(data_directory):
     """
     Associate each multistream file to its corresponding index.
@@ -59,47 +103,204 @@ def associate_to_index(data_directory):
     return to_process
 
 
-# Full part processing
-def process_part(part_file, parts_directory, last_part_name, parts_decompression_directory, database):
-    """Process one part of one multistream file into an sql database."""
+# Pool worker state, set once per worker process by init_worker
+worker_state = {}
 
-    # decompress part file
-    decompressed_part_file = multistreamfilehandling.decompress_part(parts_directory, part_file,
-                                                                     parts_decompression_directory)
-    if part_file == last_part_name:
-        wikitableprocessing.prepend_file(os.path.join(parts_decompression_directory, decompressed_part_file))
-    # extract wikitables and parse to lists
-    parsed = wikitableprocessing.parse_wikitables_from_file(os.path.join(parts_decompression_directory,
-                                                                         decompressed_part_file))
-    # process into sql database
-    tosql.process_many_wikitables_into_sql_database(parsed, database)
+
+def init_worker(data_files, engine, page_filter, table_cache_filename=None, collect_metrics=False):
+    """Set the state of each worker process (multistream files are mapped when first needed)."""
+
+    # Ctrl-C is handled by the main process only (a worker interrupted while holding the result pipe would hang
+    # the termination of the pool)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker_state['data_files'] = data_files
+    worker_state['mapped_files'] = {}
+    worker_state['engine'] = engine
+    worker_state['page_filter'] = page_filter
+    worker_state['collect_metrics'] = collect_metrics
+    worker_state['table_cache'] = None
+    if table_cache_filename is not None:
+        worker_state['table_cache'] = tablecache.open_table_cache_reader(table_cache_filename)
 
 
-def prompt_continue(name):
+def get_mapped_file(file_number):
+    """Map a multistream file once in each worker process."""
+
+    if file_number not in worker_state['mapped_files']:
+        worker_state['mapped_files'][file_number] = \
+            multistreamfilehandling.map_multistream_file(worker_state['data_files'][file_number])
+    return worker_state['mapped_files'][file_number]
+
+
+def generate_tasks(wiki_path, data_index_pairs, page_selection, use_index_cache, remaining_streams,
+                   ingested_streams=frozenset(), known_revisions=None, present_pages=None, metrics=None):
+    """
+    Generate the stream tasks of all multistream files, file by file. The pool consumes the tasks ahead of
+    the workers, so the index of the next file is parsed while the streams of the current one are processed.
+
+    :param wiki_path: path as string
+    :param data_index_pairs: list of (multistream_filename, index_filename) (see associate_to_index)
+    :param page_selection: page selection as dict (see multistreamfilehandling.new_page_selection), None for all
+    :param use_index_cache: True to use the index caches, as bool
+    :param remaining_streams: number of streams not yet processed by file number, set for each file before its
+                              first task is generated, as dict
+    :param ingested_streams: set of (multistream_filename, byte_offset) of the streams to skip
+    :param known_revisions: revision id by page id of the pages already in the output, as dict (None if empty)
+    :param present_pages: ids of the pages of known_revisions found in the indexes, updated in place, as set
+    :param metrics: stage metrics ('index'), updated in place, as dict (see stagemetrics.new_metrics), None to not
+                    collect them
+    :return: generator of tasks of the form (file_number, byte_offset, length, is_last, page_ids, revisions),
+             page_ids being the ids of the selected pages of the stream (None for all pages) and revisions the
+             known revision by page id of the pages of the stream (None if there is none)
+    """
+
+    for file_number, (data_file, index) in enumerate(data_index_pairs):
+        start = stagemetrics.start_stage(metrics)
+        index_cache = None
+        if use_index_cache:
+            index_cache = multistreamfilehandling.open_index_cache(wiki_path, index, page_selection is not None)
+        streams = multistreamfilehandling.get_streams(wiki_path, data_file, index, index_cache)
+        selected_pages = None
+        if page_selection is not None:
+            selected_pages = multistreamfilehandling.get_selected_pages(wiki_path, index, page_selection,
+                                                                        index_cache)
+            streams = [stream for stream in streams if stream[0] in selected_pages]
+        known_pages = {}
+        if known_revisions:
+            known_pages = multistreamfilehandling.get_listed_pages(wiki_path, index, known_revisions, index_cache)
+            for page_ids in known_pages.values():
+                present_pages.update(page_ids)
+        if index_cache is not None:
+            index_cache.close()
+        streams = [stream for stream in streams if (data_file, stream[0]) not in ingested_streams]
+        stagemetrics.end_stage(metrics, 'index', start, bytes_in=os.path.getsize(os.path.join(wiki_path, index)),
+                               items=len(streams))
+
+        remaining_streams[file_number] = len(streams)
+        for byte_offset, length, last_stream in streams:
+            page_ids = None if selected_pages is None else selected_pages[byte_offset]
+            revisions = None
+            if byte_offset in known_pages:
+                revisions = {k: known_revisions[k] for k in known_pages[byte_offset]}
+            yield file_number, byte_offset, length, last_stream, page_ids, revisions
+
+
+# Full stream processing
+def process_stream(task):
+    """
+    Parse the wikitables of one stream of a multistream file
+    (return the file number, the byte offset, the parsed wikitables, the skipped page counts, the pages
+    whose wikitables change, the table cache lookups and the stage metrics).
+    """
+
+    file_number, byte_offset, length, last_stream, page_ids, revisions = task
+    page_filter = dict(worker_state['page_filter'], revisions=revisions)
+    if page_ids is not None:
+        page_filter['page_ids'] = page_ids
+    metrics = stagemetrics.new_metrics() if worker_state['collect_metrics'] else None
+    # slice stream, then decompress and parse it incrementally
+    start = stagemetrics.start_stage(metrics)
+    compressed_stream = multistreamfilehandling.slice_stream(get_mapped_file(file_number), byte_offset, length)
+    stagemetrics.end_stage(metrics, 'slice', start, bytes_in=length, items=1)
+    chunks = stagemetrics.iter_timed(metrics, 'decompress',
+                                     multistreamfilehandling.iter_decompress_stream(compressed_stream), len)
+    # extract wikitables and parse to lists
+    skip_counts = wikitableprocessing.new_skip_counts()
+    page_changes = wikitableprocessing.new_page_changes()
+    parsed = wikitableprocessing.parse_wikitables_from_chunks(chunks, last_stream, worker_state['engine'],
+                                                              page_filter, skip_counts, page_changes,
+                                                              worker_state['table_cache'], metrics)
+    compressed_stream.release()
+    if metrics is not None:
+        # the decompressed stream is the input of the xml parser
+        stagemetrics.add_stage_counts(metrics, 'decompress', bytes_in=length, items=1)
+        stagemetrics.add_stage_counts(metrics, 'xml_parse', bytes_in=metrics['stages']['decompress']['bytes_out'])
+    cache_updates = None
+    if worker_state['table_cache'] is not None:
+        cache_updates = tablecache.take_table_cache_updates(worker_state['table_cache'])
+    return file_number, byte_offset, parsed, skip_counts, page_changes, cache_updates, metrics
+
+
+def prompt_continue(name, consequence=None):
     """Prompt for required user intervention."""
 
-    print(name + " already exists. " + "Data will be added to " + name + " if you continue. ")
+    if consequence is None:
+        consequence = "Data will be added to " + name + " if you continue. "
+    print(name + " already exists. " + consequence)
     prompt = "Do you want to continue? (y/n): "
     inp = input(prompt).strip().lower()
     if inp not in ['y', 'n']:
         print(inp + " is not a valid option, please try again...")
-        return prompt_continue(name)
+        return prompt_continue(name, consequence)
     return inp == 'y'
 
 
-def cleanup(files_dict):
+def output_writer(table_queue, backend, writer_options, indicators, tables_per_transaction=1000, table_cache=None,
+                  metrics=None):
+    """
+    Single writer of the output: write the lists of wikitables put on table_queue with the given
+    backend module (tosql or toarrow) until None is received, committing once every
+    tables_per_transaction tables.
+    Backlog of table_queue is reported in indicators['queue'].
+    The table cache lookups of the workers are stored in the table cache along the way.
+
+    :param table_queue: queue.Queue of (stream, list of wikitabledata, page_changes, cache_updates), stream being
+                        the (dump_file, byte_offset) recorded as ingested with the wikitables (None to not record
+                        it), page_changes the pages whose wikitables change (see
+                        wikitableprocessing.new_page_changes) and cache_updates the table cache lookups (see
+                        tablecache.new_table_cache_updates, None without table cache)
+    :param backend: output backend module
+    :param writer_options: keyword arguments of backend.open_writer as dict
+    :param indicators: progress indicators as dict
+    :param tables_per_transaction: int
+    :param table_cache: table cache writer state as dict (see tablecache.open_table_cache), None without table cache
+    :param metrics: stage metrics ('write'), updated in place, as dict (see stagemetrics.new_metrics), None to not
+                    collect them
+    :return:
+    """
+
+    writer_state = None
+    pending = 0
+
+    try:
+        writer_state = backend.open_writer(**writer_options)
+        while True:
+            item = table_queue.get()
+            indicators['queue'] = table_queue.qsize()
+            if item is None:
+                break
+            stream, wikitabledata_list, page_changes, cache_updates = item
+            start = stagemetrics.start_stage(metrics)
+            backend.write_wikitables(writer_state, wikitabledata_list, stream, page_changes)
+            pending += len(wikitabledata_list)
+            if pending >= tables_per_transaction:
+                backend.commit(writer_state)
+                pending = 0
+            stagemetrics.end_stage(metrics, 'write', start, items=len(wikitabledata_list))
+            if cache_updates is not None:
+                tablecache.store_table_cache_updates(table_cache, cache_updates)
+        start = stagemetrics.start_stage(metrics)
+        backend.commit(writer_state)
+        stagemetrics.end_stage(metrics, 'write', start)
+    except Exception as e:
+        indicators['writer_error'] = e
+        # keep consuming so that producers blocked on a full queue are released
+        while table_queue.get() is not None:
+            pass
+    finally:
+        if writer_state is not None:
+            backend.close_writer(writer_state)
+
+
+def get_output_base(data_directory):
     """
-    Removal of intermediate files.
+    Determine output filename without extension.
+
+    :param data_directory: path as string
+    :return: filename as string
     """
 
-    if os.path.exists(files_dict['decompressed_index_filename']):
-        os.remove(files_dict['decompressed_index_filename'])
-    for f in os.listdir(files_dict['parts_directory']):
-        os.remove(os.path.join(files_dict['parts_directory'], f))
-    os.rmdir(files_dict['parts_directory'])
-    for f in os.listdir(files_dict['parts_decompression_directory']):
-        os.remove(os.path.join(files_dict['parts_decompression_directory'], f))
-    os.rmdir(files_dict['parts_decompression_directory'])
+    return os.path.commonprefix(os.listdir(data_directory))
 
 
 def get_database_filename(data_directory):
@@ -110,62 +311,247 @@ def get_database_filename(data_directory):
     :return: filename as string
     """
 
-    base = os.path.commonprefix(os.listdir(data_directory))
-    return base + '.db'
+    return get_output_base(data_directory) + '.db'
 
 
 def main():
-    remove_intermediate_files = True
-
     parser = argparse.ArgumentParser(description='Extract wikitables from multistream wikipedia database dump '
-                                                 'and process them into a sqlite3 database.')
+                                                 'and process them into a sqlite3 database '
+                                                 '(or Parquet/Arrow files).')
     parser.add_argument('path', metavar='folder', type=str, nargs=1,
                         help='wikipedia multistream folder path')
+    parser.add_argument('--queue-size', type=int, default=64,
+                        help='maximum number of parsed streams waiting to be written (default: 64)')
+    parser.add_argument('--transaction-size', type=int, default=1000,
+                        help='number of wikitables written per database transaction (default: 1000)')
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help='number of rows inserted per executemany call (default: 10000)')
+    parser.add_argument('--fast-load', action='store_true',
+                        help='load with bulk-load pragmas (WAL, synchronous=OFF, large cache, in-memory temp store) '
+                             'and build the indexes only once loading is done')
+    parser.add_argument('--compact', action='store_true',
+                        help='create the database with the compact schema (integer table ids, '
+                             'row attributes stored once per row)')
+    parser.add_argument('--output-format', choices=['sqlite', 'parquet', 'arrow'], default='sqlite',
+                        help='write a sqlite3 database (default) or one Parquet/Arrow IPC file per table '
+                             '(requires pyarrow)')
+    parser.add_argument('--parser-engine', choices=wikitableparser.parser_engines, default='token',
+                        help='wikitable parser engine: token-based (default) or character by character')
+    parser.add_argument('--namespaces', type=int, nargs='+', metavar='NS',
+                        help='only process the pages of these namespaces, e.g. 0 for articles (default: all)')
+    parser.add_argument('--skip-redirects', action='store_true',
+                        help='skip redirect pages')
+    parser.add_argument('--titles', type=str, nargs='+', metavar='TITLE',
+                        help='only process the pages with these titles')
+    parser.add_argument('--titles-file', type=str, metavar='FILE',
+                        help='only process the pages whose titles are listed in FILE (one title per line)')
+    parser.add_argument('--page-ids', type=int, nargs='+', metavar='ID',
+                        help='only process the pages with these ids')
+    parser.add_argument('--title-regex', type=str, metavar='REGEX',
+                        help='only process the pages whose titles match REGEX (re.search)')
+    parser.add_argument('--no-index-cache', action='store_true',
+                        help='parse the multistream indexes without reading or writing their cache files')
+    parser.add_argument('--refresh-from', type=str, metavar='DATABASE',
+                        help='start from a copy of the database of a previous dump and only parse the new and '
+                             'changed pages (the rows of changed and removed pages are replaced or deleted)')
+    parser.add_argument('--table-cache', type=str, metavar='FILE',
+                        help='reuse the parsed wikitables stored in the sqlite3 file FILE (created if needed) for '
+                             'identical raw wikitables, and store the newly parsed ones')
+    parser.add_argument('--table-cache-size', type=int, default=1024, metavar='MB',
+                        help='maximum size of the table cache, least recently used wikitables are evicted '
+                             'beyond it (default: 1024)')
+    parser.add_argument('--metrics', type=str, metavar='FILE',
+                        help='write the per-stage timings, byte counts, throughputs and queue depths to FILE as JSON '
+                             'lines, and print a summary at the end')
+    parser.add_argument('--metrics-interval', type=float, default=10, metavar='SECONDS',
+                        help='seconds between two lines of the metrics file (default: 10)')
     args = parser.parse_args()
+    if args.refresh_from is not None and args.output_format != 'sqlite':
+        parser.error('--refresh-from requires the sqlite output format')
+    if args.compact and args.output_format != 'sqlite':
+        parser.error('--compact requires the sqlite output format')
+    if args.fast_load and args.output_format != 'sqlite':
+        parser.error('--fast-load requires the sqlite output format')
+    if args.output_format != 'sqlite' and toarrow.pyarrow_check is None:
+        parser.error('--output-format ' + args.output_format + ' requires pyarrow')
     wiki_path = args.path[0]
     
     indicators = {}
     indicators['done'] = 0
     indicators['end'] = False
     indicators['terminate'] = False
+    indicators['queue'] = 0
+    indicators['queue_size'] = args.queue_size
+    indicators['skipped'] = wikitableprocessing.new_skip_counts()
+    indicators['received'] = 0
+    indicators['start_time'] = time.perf_counter()
+
+    page_filter = wikitableprocessing.new_page_filter(args.namespaces, args.skip_redirects)
+    # Pages selected by title or id (only the streams holding them are processed)
+    page_selection = None
+    if args.titles or args.titles_file or args.page_ids or args.title_regex is not None:
+        titles = list(args.titles or [])
+        if args.titles_file:
+            with open(args.titles_file, mode='r', encoding='UTF-8') as f:
+                titles.extend(line.rstrip('\r\n') for line in f if line.strip())
+        page_selection = multistreamfilehandling.new_page_selection(titles, args.page_ids, args.title_regex)
 
     data_index_pairs = associate_to_index(wiki_path)
+    ingested_streams = set()
+    known_revisions = {}
     indicators['total'] = len(data_index_pairs)
-    database_filename = get_database_filename(wiki_path)
 
     progress = threading.Thread(target=progress_animator, args=(indicators,))
-    
-    # Check if database exists
-    if os.path.exists(database_filename):
-        indicators['terminate'] = not prompt_continue(database_filename)
-        if indicators['terminate']:
-            print("Process Terminated.")
-            sys.exit(0)
+
+    if args.output_format == 'sqlite':
+        database_filename = get_database_filename(wiki_path)
+        # Streams are recorded as ingested with their rows, except for page selections (partial streams)
+        if page_selection is None:
+            page_filter_key = wikitableprocessing.get_page_filter_key(page_filter)
+        else:
+            page_filter_key = None
+        # Refresh: copy the database of the previous dump (unless the refresh is being resumed)
+        if args.refresh_from is not None and not os.path.exists(database_filename):
+            if not tosql.has_progress_table(args.refresh_from) or not tosql.has_page_ids(args.refresh_from) or \
+                    not tosql.get_page_revisions(args.refresh_from):
+                print(args.refresh_from + " does not record page revisions, it cannot be refreshed.")
+                sys.exit(1)
+            print("Copying " + args.refresh_from + " to " + database_filename + " ...")
+            shutil.copyfile(args.refresh_from, database_filename)
+        # Check if database exists (it is resumed if it records its progress)
+        if os.path.exists(database_filename):
+            if page_filter_key is not None and tosql.has_progress_table(database_filename):
+                # streams ingested with the same page filter or with no page filter are skipped
+                ingested_streams = tosql.get_ingested_streams(
+                    database_filename,
+                    {page_filter_key, wikitableprocessing.get_page_filter_key(wikitableprocessing.new_page_filter())})
+                # streams of the current dump only (a refreshed database also holds those of the previous dump)
+                ingested_streams = {k for k in ingested_streams if k[0] in {i[0] for i in data_index_pairs}}
+                print("Resuming " + database_filename + " (" + str(len(ingested_streams)) +
+                      " streams already ingested).")
+            else:
+                indicators['terminate'] = not prompt_continue(database_filename)
+                if indicators['terminate']:
+                    print("Process Terminated.")
+                    sys.exit(0)
+        else:
+            tosql.sql_table_creation(database_filename, 'compact' if args.compact else 'default')
+        schema = tosql.get_schema(database_filename)
+        # pages already in the database are only parsed again if their revision changed
+        known_revisions = tosql.get_page_revisions(database_filename)
+
+        print("Database filename: ", database_filename)
+
+        # the indexes are kept when rows of existing pages may be deleted
+        if args.fast_load and not known_revisions:
+            tosql.drop_indexes(database_filename, schema)
+        backend = tosql
+        writer_options = {'database': database_filename, 'batch_size': args.batch_size, 'fast_load': args.fast_load,
+                          'page_filter_key': page_filter_key, 'refresh': args.refresh_from is not None}
     else:
-        tosql.sql_table_creation(database_filename)
-        
-    print("Database filename: ", database_filename)
-        
+        output_base = get_output_base(wiki_path)
+        for filename in toarrow.get_output_filenames(output_base, args.output_format).values():
+            if os.path.exists(filename):
+                indicators['terminate'] = not prompt_continue(filename, filename + " will be overwritten if you "
+                                                                                   "continue. ")
+                if indicators['terminate']:
+                    print("Process Terminated.")
+                    sys.exit(0)
+            print("Output filename: ", filename)
+        backend = toarrow
+        writer_options = {'base': output_base, 'output_format': args.output_format}
+
+    # created before the pool starts, its workers only read it
+    table_cache = None
+    if args.table_cache is not None:
+        table_cache = tablecache.open_table_cache(args.table_cache, args.table_cache_size * 1024 * 1024)
+
+    # stage metrics of the workers (added up by stream), of the index parsing and of the writer, one per thread
+    metrics_list = []
+    worker_metrics = index_metrics = writer_metrics = None
+    if args.metrics is not None:
+        worker_metrics, index_metrics, writer_metrics = metrics_list = [stagemetrics.new_metrics() for k in range(3)]
+        reporter = threading.Thread(target=metrics_reporter,
+                                    args=(indicators, metrics_list, args.metrics, args.metrics_interval))
+        reporter.start()
+
     progress.start()
-    
-    for i in data_index_pairs:
-        files_info = multistreamfilehandling.prepare_parts_using_index(wiki_path, i[0], i[1], indicators['done'])
-        process_part_directory_set = \
-            functools.partial(process_part, parts_directory=files_info['parts_directory'],
-                              last_part_name=files_info['last_part_name'],
-                              parts_decompression_directory=files_info['parts_decompression_directory'],
-                              database=database_filename)
-        parts = os.listdir(files_info['parts_directory'])
-        
-        # main multiprocessing loop (by batch of 100 pages)
-        with multiprocessing.Pool() as pool:
-            pool.map(process_part_directory_set, parts)
-
-        if remove_intermediate_files:
-            cleanup(files_info)
-
-        indicators['done'] += 1
+
+    # single output writer fed by the workers through a bounded queue
+    table_queue = queue.Queue(maxsize=args.queue_size)
+    writer = threading.Thread(target=output_writer,
+                              args=(table_queue, backend, writer_options, indicators, args.transaction_size,
+                                    table_cache, writer_metrics))
+    writer.start()
+
+    # one pool for all files (by stream of 100 pages), only stream locations are sent to the workers
+    remaining_streams = {}
+    present_pages = set()
+    tasks = generate_tasks(wiki_path, data_index_pairs, page_selection, not args.no_index_cache, remaining_streams,
+                           ingested_streams, known_revisions, present_pages, index_metrics)
+    data_files = [os.path.join(wiki_path, i[0]) for i in data_index_pairs]
+    interrupted = False
+    completed = False
+    try:
+        try:
+            with multiprocessing.Pool(initializer=init_worker,
+                                      initargs=(data_files, args.parser_engine, page_filter, args.table_cache,
+                                                args.metrics is not None)) as pool:
+                for file_number, byte_offset, parsed, skip_counts, page_changes, cache_updates, metrics in \
+                        pool.imap_unordered(process_stream, tasks):
+                    # the rest of the dump is not processed once the output cannot be written (the pool is
+                    # terminated)
+                    if 'writer_error' in indicators:
+                        break
+                    remaining_streams[file_number] -= 1
+                    indicators['received'] += 1
+                    if metrics is not None:
+                        stagemetrics.add_metrics(worker_metrics, metrics)
+                    indicators['done'] = list(remaining_streams.values()).count(0)
+                    wikitableprocessing.add_skip_counts(indicators['skipped'], skip_counts)
+                    table_queue.put(((data_index_pairs[file_number][0], byte_offset), parsed, page_changes,
+                                     cache_updates))
+                    indicators['queue'] = table_queue.qsize()
+            indicators['done'] = list(remaining_streams.values()).count(0)
+        except KeyboardInterrupt:
+            # the streams already queued are still written, the others are processed when the run is resumed
+            interrupted = True
+        completed = True
+    finally:
+        # the queued streams are written even if a worker or the index parsing failed, then the error is raised
+        # once the writer, progress and metrics threads have ended
+        table_queue.put(None)
+        writer.join()
+        if not completed:
+            indicators['end'] = True
+    if table_cache is not None:
+        tablecache.close_table_cache(table_cache)
+    indicators['terminate'] = interrupted or 'writer_error' in indicators
+    # pages of the database missing from the whole dump were removed
+    removed_pages = set()
+    if not indicators['terminate'] and page_selection is None and known_revisions:
+        removed_pages = set(known_revisions) - present_pages
+        tosql.delete_pages(database_filename, removed_pages)
+    if not indicators['terminate'] and args.output_format == 'sqlite':
+        tosql.create_indexes(database_filename, schema)
     indicators['end'] = True
+    progress.join()
+    if args.metrics is not None:
+        reporter.join()
+        snapshot = get_metrics_snapshot(metrics_list, indicators)
+        with open(args.metrics, mode='a', encoding='UTF-8') as f:
+            stagemetrics.write_snapshot(f, snapshot)
+        print('\n'.join(stagemetrics.format_summary(snapshot)))
+    if 'writer_error' in indicators:
+        raise indicators['writer_error']
+    if interrupted:
+        sys.exit(1)
+    print('Skipped pages: ' + ', '.join(reason.replace('_', ' ') + ': ' + str(count)
+                                        for reason, count in indicators['skipped'].items()))
+    if removed_pages:
+        print('Removed pages: ' + str(len(removed_pages)))
+    if table_cache is not None:
+        print('Table cache: hits: ' + str(table_cache['hits']) + ', misses: ' + str(table_cache['misses']))
 
 
 if __name__ == '__main__':